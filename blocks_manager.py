@@ -14,67 +14,160 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import heapq
 import itertools
-import operator
+import re
+import threading
+import weakref
+import zlib
+from array import array
+from collections import OrderedDict
+
+# Unsigned 64-bit block numbers, stored contiguously.
+RANGE_DATA_TYPECODE = 'Q'
+# "start-end" or "block" in .map files, end inclusive.
+RANGE_TEXT_RE = re.compile(r"(\d+)(?:-(\d+))?")
+# BlockBitmap byte values.
+BITMAP_SET = b'\x01'
+BITMAP_CLEAR = b'\x00'
+BITMAP_INVERT_TABLE = bytes([1, 0]) + bytes(254)
+# Number of set operation results BlocksManager keeps.
+BLOCKS_MEMO_SIZE = 16384
+
+
+class RangeDataKey(object):
+    """
+    Hashable key of range data without copying it, the hash is the crc32
+    of the data bytes so that it is the same in every run.
+    """
+    __slots__ = ('data', 'hash_value')
+
+    def __init__(self, data):
+        self.data = data
+        self.hash_value = zlib.crc32(data)
+
+    def __hash__(self):
+        return self.hash_value
+
+    def __eq__(self, other):
+        return self.data == other.data
 
 
 class BlocksManager(object):
     """
-    blocks manager
+    blocks manager, immutable. Equal range data always gives the same
+    instance, so the results of the set operations are memoized by the
+    identity of the operands. The memo keeps its operands alive, call
+    clear_memo() once an image is processed.
     """
+    __slots__ = ('__data', '__monotonic', '__size', '__prefix',
+                 '__raw_string', '__hash', '__weakref__')
+    # range data key -> instance, and (operation, id, id) -> result
+    __instances = weakref.WeakValueDictionary()
+    __memo = OrderedDict()
+    __lock = threading.Lock()
 
-    def __init__(self, range_data=None):
-        self.monotonic = False
+    def __new__(cls, range_data=None):
         if isinstance(range_data, str):
-            self.__parse_data_text(range_data)
+            data = cls.__parse_data_text(range_data)
         elif range_data:
             if len(range_data) % 2 != 0:
                 raise RuntimeError
-            self.range_data = tuple(self.__remove_repeated_pairs(range_data))
-            self.monotonic = all(
-                x < y for x, y in zip(self.range_data, self.range_data[1:]))
+            data = array(RANGE_DATA_TYPECODE,
+                         cls.__remove_repeated_pairs(range_data))
         else:
-            self.range_data = ()
+            data = array(RANGE_DATA_TYPECODE)
+        key = RangeDataKey(data)
+        self = cls.__instances.get(key)
+        if self is not None:
+            return self
+        self = object.__new__(cls)
+        self.__data = data
+        self.__monotonic = all(x < y for x, y in zip(data, data[1:]))
+        self.__size = None
+        self.__prefix = None
+        self.__raw_string = None
+        self.__hash = key.hash_value
+        with cls.__lock:
+            return cls.__instances.setdefault(key, self)
+
+    def __reduce__(self):
+        return BlocksManager, (self.__data,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __iter__(self):
-        for i in range(0, len(self.range_data), 2):
-            yield self.range_data[i:i + 2]
+        data = self.__data
+        for i in range(0, len(data), 2):
+            yield data[i], data[i + 1]
 
     def __eq__(self, other):
-        return self.range_data == other.range_data
+        return self is other or self.__data == other.__data
 
     def __ne__(self, other):
-        return self.range_data != other.range_data
+        return not self == other
+
+    def __hash__(self):
+        return self.__hash
+
+    @property
+    def monotonic(self):
+        """
+        Whether the range data is strictly increasing.
+        """
+        return self.__monotonic
+
+    @classmethod
+    def clear_memo(cls):
+        """
+        Drop the memoized set operation results and the operands they keep
+        alive.
+        """
+        with cls.__lock:
+            cls.__memo.clear()
 
-    def __parse_data_text(self, text):
+    @property
+    def range_data(self):
+        """
+        Range data as a tuple, kept for callers comparing against tuples.
+        Use range_view() to read the data without copying it.
+        """
+        return tuple(self.__data)
+
+    def range_view(self):
+        """
+        Obtain a read-only, zero-copy view of the range data.
+        """
+        return memoryview(self.__data).toreadonly()
+
+    @classmethod
+    def __parse_data_text(cls, text):
         """
         Parse data from text content.
         """
         data = []
-        monotonic = True
-        last = -1
-        for split_content in text.split():
-            if "-" in split_content:
-                start_value, end_value = \
-                    (int(n) for n in split_content.split("-"))
+        if "-0" in text:
+            # "0-0" cannot be told apart from "0" by the sign trick below.
+            for start_text, end_text in RANGE_TEXT_RE.findall(text):
+                start_value = int(start_text)
                 data.append(start_value)
-                data.append(end_value + 1)
-                if last <= start_value <= end_value:
-                    last = end_value
-                else:
-                    monotonic = False
-            else:
-                int_content = int(split_content)
-                data.append(int_content)
-                data.append(int_content + 1)
-                if last <= int_content:
-                    last = int_content + 1
+                data.append(int(end_text) + 1 if end_text else start_value + 1)
+        else:
+            # Convert all numbers in one go, range ends come out negative.
+            for value in map(int, text.replace("-", " -").split()):
+                if value < 0:
+                    data[-1] = 1 - value
                 else:
-                    monotonic = False
-        data.sort()
-        self.range_data = tuple(self.__remove_repeated_pairs(data))
-        self.monotonic = monotonic
+                    data.append(value)
+                    data.append(value + 1)
+        if not all(x <= y for x, y in zip(data, data[1:])):
+            data.sort()
+        return array(RANGE_DATA_TYPECODE, cls.__remove_repeated_pairs(data))
 
     @staticmethod
     def __remove_repeated_pairs(source):
@@ -92,79 +185,189 @@ class BlocksManager(object):
         if new is not None:
             yield new
 
+    @staticmethod
+    def from_string_raw(text):
+        """
+        Parse a transfer.list range field such as "4,0,10,20,30".
+        :param text: range field created by to_string_raw
+        :return: BlocksManager
+        """
+        values = text.split(",")
+        if int(values[0]) != len(values) - 1:
+            raise RuntimeError
+        return BlocksManager(range_data=array(
+            RANGE_DATA_TYPECODE, map(int, values[1:])))
+
     def to_string_raw(self):
-        if len(self.range_data) == 0:
+        if len(self.__data) == 0:
             raise RuntimeError
-        return "".join([str(len(self.range_data)), ",", ",".join(
-            str(i) for i in self.range_data)])
+        if self.__raw_string is None:
+            self.__raw_string = "".join([str(len(self.__data)), ",", ",".join(
+                map(str, self.__data))])
+        return self.__raw_string
+
+    @staticmethod
+    def __merge_sweep(data_a, data_b, keep_table):
+        """
+        Sweep the sorted boundaries of two range sets in a single pass.
+        keep_table is indexed by (in_a | in_b << 1) and tells whether
+        the blocks covered by that combination belong to the result.
+        """
+        new_data = []
+        len_a, len_b = len(data_a), len(data_b)
+        i, j = 0, 0
+        state = 0
+        inside = False
+        while i < len_a or j < len_b:
+            if j >= len_b or (i < len_a and data_a[i] < data_b[j]):
+                value = data_a[i]
+            else:
+                value = data_b[j]
+            while i < len_a and data_a[i] == value:
+                state ^= 1
+                i += 1
+            while j < len_b and data_b[j] == value:
+                state ^= 2
+                j += 1
+            if keep_table[state] != inside:
+                inside = not inside
+                new_data.append(value)
+        return new_data
+
+    def __sorted_data(self):
+        """
+        Obtain range data as sorted, non-overlapping pairs.
+        """
+        data = self.__data
+        if self.__monotonic:
+            return data
+        pairs = sorted(zip(data[::2], data[1::2]))
+        new_data = []
+        for start_value, end_value in pairs:
+            if new_data and start_value <= new_data[-1]:
+                new_data[-1] = max(new_data[-1], end_value)
+            else:
+                new_data.append(start_value)
+                new_data.append(end_value)
+        return new_data
+
+    def __memo_sweep(self, other, keep_table):
+        """
+        Run __merge_sweep on self and other, or return the memoized
+        result. The memo entry holds the operands, so their ids stay
+        unique while it is kept.
+        """
+        memo = BlocksManager.__memo
+        key = (keep_table, id(self), id(other))
+        with BlocksManager.__lock:
+            entry = memo.get(key)
+            if entry is not None:
+                memo.move_to_end(key)
+                return entry[2]
+        result = BlocksManager(range_data=self.__merge_sweep(
+            self.__sorted_data(), other.__sorted_data(), keep_table))
+        with BlocksManager.__lock:
+            memo[key] = (self, other, result)
+            if len(memo) > BLOCKS_MEMO_SIZE:
+                memo.popitem(last=False)
+        return result
 
     def get_union_with_other(self, other):
         """
-        Obtain the intersection.
+        Obtain the union.
         """
-        range_a = self.get_subtract_with_other(other)
-        range_b = other.get_subtract_with_other(self)
-        range_c = self.get_intersect_with_other(other)
-        range_e, range_f, range_g = \
-            list(range_a.range_data), list(range_b.range_data), list(
-                range_c.range_data)
-        range_d = []
-        range_d.extend(range_e)
-        range_d.extend(range_f)
-        range_d.extend(range_g)
-        range_d.sort()
-        return BlocksManager(range_data=range_d)
+        return self.__memo_sweep(other, (False, True, True, True))
 
     def get_intersect_with_other(self, other):
         """
         Obtain the intersection.
         """
-        other_data, data, new_data = list(self.range_data), list(
-            other.range_data), []
-        for i in range(len(data) // 2):
-            for j in range(len(other_data) // 2):
-                data_list1 = [data[i * 2], data[i * 2 + 1], other_data[j * 2],
-                              other_data[j * 2 + 1]]
-                data_list2 = [other_data[j * 2], other_data[j * 2 + 1],
-                              data[i * 2], data[i * 2 + 1]]
-                sort_list = [data[i * 2], data[i * 2 + 1], other_data[j * 2],
-                             other_data[j * 2 + 1]]
-                sort_list.sort()
-                if operator.ne(sort_list, data_list1) and \
-                        operator.ne(sort_list, data_list2):
-                    new_data.append(sort_list[1])
-                    new_data.append(sort_list[2])
-        return BlocksManager(range_data=new_data)
+        return self.__memo_sweep(other, (False, False, False, True))
 
     def get_subtract_with_other(self, other):
         """
         Obtain the difference set.
         """
-        intersect_ran = self.get_intersect_with_other(other)
-        data, intersect_data = list(self.range_data), list(
-            intersect_ran.range_data)
-        new_data = data + intersect_data
-        new_data.sort()
-        return BlocksManager(range_data=new_data)
+        return self.__memo_sweep(other, (False, True, False, False))
+
+    @staticmethod
+    def __k_way_sweep(data_list, threshold):
+        """
+        Merge the sorted boundaries of many range sets with a heap and
+        keep the blocks covered by at least threshold of them.
+        """
+        events = heapq.merge(*(zip(data, itertools.cycle((1, -1)))
+                               for data in data_list))
+        new_data = []
+        count = 0
+        inside = False
+        for value, group in itertools.groupby(events, key=lambda x: x[0]):
+            count += sum(delta for _, delta in group)
+            if (count >= threshold) != inside:
+                inside = not inside
+                new_data.append(value)
+        return new_data
+
+    @staticmethod
+    def union_all(blocks_iterable):
+        """
+        Obtain the union of many BlocksManagers in one k-way merge.
+        """
+        data_list = [blocks.__sorted_data() for blocks in blocks_iterable]
+        return BlocksManager(range_data=BlocksManager.__k_way_sweep(
+            data_list, 1))
+
+    @staticmethod
+    def intersect_all(blocks_iterable):
+        """
+        Obtain the intersection of many BlocksManagers in one k-way merge.
+        """
+        data_list = [blocks.__sorted_data() for blocks in blocks_iterable]
+        if not data_list:
+            return BlocksManager()
+        return BlocksManager(range_data=BlocksManager.__k_way_sweep(
+            data_list, len(data_list)))
 
     def is_overlaps(self, other):
         """
         Determine whether there is non-empty overlap.
         """
-        intersect_range = self.get_intersect_with_other(other)
-        if intersect_range.size():
-            return True
+        data_a, data_b = self.__sorted_data(), other.__sorted_data()
+        len_a, len_b = len(data_a), len(data_b)
+        i, j = 0, 0
+        while i < len_a and j < len_b:
+            if data_a[i + 1] <= data_b[j]:
+                i += 2
+            elif data_b[j + 1] <= data_a[i]:
+                j += 2
+            else:
+                return True
         return False
 
     def size(self):
         """
         Obtain the self size.
         """
-        total = 0
-        data = list(self.range_data)
-        for i in range(len(data) // 2):
-            total += data[i * 2 + 1] - data[i * 2]
-        return total
+        if self.__size is None:
+            data_view = memoryview(self.__data)
+            self.__size = sum(data_view[1::2]) - sum(data_view[::2])
+        return self.__size
+
+    def __get_prefix(self):
+        """
+        Obtain the cumulative block count in front of each range pair,
+        built on first use.
+        """
+        if self.__prefix is None:
+            data = self.__data
+            prefix = array(RANGE_DATA_TYPECODE, [0])
+            total = 0
+            for i in range(0, len(data), 2):
+                total += data[i + 1] - data[i]
+                prefix.append(total)
+            self.__prefix = prefix
+            self.__size = total
+        return self.__prefix
 
     def get_map_within(self, other):
         """
@@ -177,8 +380,8 @@ class BlocksManager(object):
         offset = 0
         start = None
         for be_num, af_num in \
-                heapq.merge(zip(self.range_data, itertools.cycle((-5, +5))),
-                            zip(other.range_data, itertools.cycle((-1, +1)))):
+                heapq.merge(zip(self.__data, itertools.cycle((-5, +5))),
+                            zip(other.__data, itertools.cycle((-1, +1)))):
             if af_num == -5:
                 start = be_num
             elif af_num == +5:
@@ -194,20 +397,18 @@ class BlocksManager(object):
         :param value:
         :return:
         """
-        data = list(self.range_data)
-        remove_data = []
-        for i in range(len(data) // 2):
-            data[i * 2 + 1] = data[i * 2 + 1] + value
-            data[i * 2] = max(0, data[i * 2] - value)
-        for i in range(len(data) // 2 - 1):
-            sign_1 = data[i * 2 + 1]
-            sign_2 = data[(i + 1) * 2]
-            if sign_1 >= sign_2:
-                remove_data.append(sign_2)
-                remove_data.append(sign_1)
-        for j in remove_data:
-            data.remove(j)
-        return BlocksManager(data)
+        data = self.__sorted_data()
+        new_data = []
+        for i in range(0, len(data), 2):
+            start_value = max(0, data[i] - value)
+            end_value = data[i + 1] + value
+            # Merge the pair into the previous one once they touch.
+            if new_data and start_value <= new_data[-1]:
+                new_data[-1] = max(new_data[-1], end_value)
+            else:
+                new_data.append(start_value)
+                new_data.append(end_value)
+        return BlocksManager(new_data)
 
     def get_first_block_obj(self, value):
         """
@@ -215,15 +416,378 @@ class BlocksManager(object):
         :param value:
         :return:
         """
+        return self.split_first_block_obj(value)[0]
+
+    def split_first_block_obj(self, value):
+        """
+        Split self into the first value blocks and the remaining blocks.
+        :param value: number of blocks in the first part
+        :return: first part, remaining part
+        """
         if self.size() <= value:
-            return self
-        data = list(self.range_data)
-        be_value, af_value = 0, 1
-        for i in range(len(data) // 2):
-            be_value += data[i * 2 + 1] - data[i * 2]
-            if be_value > value:
-                data[i * 2 + 1] = data[i * 2 + 1] - be_value + value
+            return self, BlocksManager()
+        data = self.__data
+        prefix = self.__get_prefix()
+        idx = bisect.bisect_left(prefix, value)
+        if prefix[idx] == value:
+            return BlocksManager(range_data=data[:idx * 2]), \
+                BlocksManager(range_data=data[idx * 2:])
+        # The idx-1 pair is cut at the split point.
+        cut_value = data[idx * 2 - 1] - (prefix[idx] - value)
+        first_data = data[:idx * 2]
+        first_data[-1] = cut_value
+        remain_data = data[idx * 2 - 2:]
+        remain_data[0] = cut_value
+        return BlocksManager(range_data=first_data), \
+            BlocksManager(range_data=remain_data)
+
+    def split_by_block_count(self, value):
+        """
+        Yield self in consecutive pieces of value blocks, the last piece
+        holding whatever is left.
+        :param value: number of blocks in each piece
+        :return:
+        """
+        if value <= 0:
+            raise RuntimeError
+        piece = []
+        remain = value
+        for start_value, end_value in self:
+            while start_value < end_value:
+                this_read = min(remain, end_value - start_value)
+                piece.append(start_value)
+                piece.append(start_value + this_read)
+                start_value += this_read
+                remain -= this_read
+                if remain == 0:
+                    yield BlocksManager(range_data=piece)
+                    piece = []
+                    remain = value
+        if piece:
+            yield BlocksManager(range_data=piece)
+
+
+class BlockBitmap(object):
+    """
+    Dense block set holding one byte per block, 1 for set blocks.
+    Set operations run over the whole map as big integers, so they do
+    not depend on how fragmented the set is. Converting costs one pass
+    over total_blocks, which pays off for per-block number lists such as
+    the A/B copy blocks; sets already held as ranges stay BlocksManager.
+    """
+    __slots__ = ('total_blocks', '__bits')
+
+    def __init__(self, total_blocks, bits=None):
+        self.total_blocks = total_blocks
+        if bits is None:
+            bits = bytearray(total_blocks)
+        elif len(bits) != total_blocks:
+            raise RuntimeError
+        self.__bits = bits
+
+    def __eq__(self, other):
+        return self.__bits == other.__bits
+
+    def __ne__(self, other):
+        return self.__bits != other.__bits
+
+    @staticmethod
+    def from_blocks(blocks, total_blocks):
+        """
+        Create a bitmap from a BlocksManager.
+        :param blocks: BlocksManager, all blocks must be below total_blocks
+        :param total_blocks: number of blocks the bitmap covers
+        :return: BlockBitmap
+        """
+        bits = bytearray(total_blocks)
+        for start_value, end_value in blocks:
+            if end_value > total_blocks:
+                raise RuntimeError
+            bits[start_value:end_value] = BITMAP_SET * (end_value - start_value)
+        return BlockBitmap(total_blocks, bits)
+
+    @staticmethod
+    def from_block_numbers(block_numbers, total_blocks):
+        """
+        Create a bitmap from single block numbers,
+        numbers at or above total_blocks are ignored.
+        """
+        bits = bytearray(total_blocks)
+        for block in block_numbers:
+            if block < total_blocks:
+                bits[block] = 1
+        return BlockBitmap(total_blocks, bits)
+
+    def to_blocks(self):
+        """
+        Convert the bitmap back to a BlocksManager.
+        """
+        bits = self.__bits
+        data = []
+        end_value = 0
+        while True:
+            start_value = bits.find(BITMAP_SET, end_value)
+            if start_value < 0:
                 break
+            end_value = bits.find(BITMAP_CLEAR, start_value)
+            if end_value < 0:
+                end_value = self.total_blocks
+            data.append(start_value)
+            data.append(end_value)
+        return BlocksManager(range_data=data)
+
+    def size(self):
+        """
+        Obtain the number of set blocks.
+        """
+        return self.__bits.count(BITMAP_SET)
+
+    def __combine(self, other, operation):
+        if self.total_blocks != other.total_blocks:
+            raise RuntimeError
+        value = operation(int.from_bytes(self.__bits, 'little'),
+                          int.from_bytes(other.__bits, 'little'))
+        return BlockBitmap(self.total_blocks, bytearray(
+            value.to_bytes(self.total_blocks, 'little')))
+
+    def get_union_with_other(self, other):
+        """
+        Obtain the union.
+        """
+        return self.__combine(other, lambda x, y: x | y)
+
+    def get_intersect_with_other(self, other):
+        """
+        Obtain the intersection.
+        """
+        return self.__combine(other, lambda x, y: x & y)
+
+    def get_subtract_with_other(self, other):
+        """
+        Obtain the difference set.
+        """
+        return self.__combine(other, lambda x, y: x ^ (x & y))
+
+    def get_complement(self):
+        """
+        Obtain the blocks of [0, total_blocks) not in self.
+        """
+        return BlockBitmap(self.total_blocks, bytearray(
+            self.__bits.translate(BITMAP_INVERT_TABLE)))
+
+
+def read_block_map_file(map_path):
+    """
+    Read a whole .map file at once.
+    :param map_path: map file path
+    :return: list of (file path, BlocksManager) in file order
+    """
+    with open(map_path, 'r') as f_r:
+        content = f_r.read()
+    map_list = []
+    for each_line in content.splitlines():
+        if not each_line.strip():
+            continue
+        each_map_path, ranges_value = each_line.split(None, 1)
+        map_list.append((each_map_path, BlocksManager(ranges_value)))
+    return map_list
+
+
+def clip_blocks_in_order(blocks_list, limit_blocks):
+    """
+    Clip each blocks to limit_blocks minus the blocks already taken by the
+    earlier entries of blocks_list, in one sweep over all the ranges.
+    :param blocks_list: list of BlocksManager, earlier entries win
+    :param limit_blocks: BlocksManager the entries are clipped to
+    :return: list of clipped BlocksManager, blocks of limit_blocks left over
+    """
+    intervals = sorted(
+        (start, end, idx) for idx, blocks in enumerate(blocks_list)
+        for start, end in blocks)
+    points = sorted(set(itertools.chain.from_iterable(
+        (start, end) for start, end, _ in intervals)))
+    # Sweep the range boundaries, each segment belongs to the lowest
+    # index that covers it.
+    segments = []
+    active = []
+    pos = 0
+    for point, next_point in zip(points, points[1:]):
+        while pos < len(intervals) and intervals[pos][0] == point:
+            heapq.heappush(active, (intervals[pos][2], intervals[pos][1]))
+            pos += 1
+        while active and active[0][1] <= point:
+            heapq.heappop(active)
+        if not active:
+            continue
+        owner = active[0][0]
+        if segments and segments[-1][2] == owner and \
+                segments[-1][1] == point:
+            segments[-1][1] = next_point
+        else:
+            segments.append([point, next_point, owner])
+
+    clipped_data = [[] for _ in blocks_list]
+    limit_pairs = list(limit_blocks)
+    limit_idx = 0
+    for start, end, owner in segments:
+        while limit_idx < len(limit_pairs) and \
+                limit_pairs[limit_idx][1] <= start:
+            limit_idx += 1
+        idx = limit_idx
+        while idx < len(limit_pairs) and limit_pairs[idx][0] < end:
+            clipped_data[owner].extend((max(start, limit_pairs[idx][0]),
+                                        min(end, limit_pairs[idx][1])))
+            idx += 1
+    covered_blocks = BlocksManager(range_data=list(
+        itertools.chain.from_iterable(segment[:2] for segment in segments)))
+    return [BlocksManager(range_data=data) for data in clipped_data], \
+        limit_blocks.get_subtract_with_other(covered_blocks)
+
+
+def iter_overlap_pairs(left_list, right_list):
+    """
+    Sweep the sorted ranges of two lists of BlocksManager together and
+    find every pair of overlapping ranges.
+    :param left_list: list of BlocksManager
+    :param right_list: list of BlocksManager
+    :return: yield (left index, right index, start, end) of each overlap
+    """
+    intervals = sorted(
+        (start, end, side, idx)
+        for side, blocks_list in enumerate((left_list, right_list))
+        for idx, blocks in enumerate(blocks_list)
+        for start, end in blocks if start < end)
+    # Ranges still open at the current start, as (end, idx) per side.
+    active = ([], [])
+    for start, end, side, idx in intervals:
+        other_active = []
+        for other_end, other_idx in active[1 - side]:
+            if other_end <= start:
+                continue
+            other_active.append((other_end, other_idx))
+            if side == 0:
+                yield idx, other_idx, start, min(end, other_end)
             else:
-                af_value += 1
-        return BlocksManager(range_data=data[:af_value * 2])
+                yield other_idx, idx, start, min(end, other_end)
+        active[1 - side][:] = other_active
+        active[side].append((end, idx))
+
+
+class BlocksAccumulator(object):
+    """
+    Collect BlocksManagers to be united, deferring the merge
+    until the union is read.
+    """
+    __slots__ = ('__pending', '__blocks')
+
+    def __init__(self):
+        self.__pending = []
+        self.__blocks = BlocksManager()
+
+    def add(self, blocks):
+        """
+        Add blocks to the union.
+        :param blocks: BlocksManager to add
+        """
+        self.__pending.append(blocks)
+
+    def get_blocks(self):
+        """
+        Obtain the union of all blocks added so far.
+        :return: BlocksManager
+        """
+        if self.__pending:
+            self.__pending.append(self.__blocks)
+            self.__blocks = BlocksManager.union_all(self.__pending)
+            self.__pending = []
+        return self.__blocks
+
+
+class BlocksOverlapIndex(object):
+    """
+    Static interval index over the ranges of many BlocksManagers.
+    Built once, it tells which of them overlap a given range set.
+    """
+    __slots__ = ('keys', '__starts', '__ends', '__owners', '__tree',
+                 '__leaf_count')
+
+    def __init__(self, items):
+        """
+        :param items: iterable of (key, BlocksManager) pairs
+        """
+        self.keys = []
+        intervals = []
+        for owner, (key, blocks) in enumerate(items):
+            self.keys.append(key)
+            for start_value, end_value in blocks:
+                if start_value < end_value:
+                    intervals.append((start_value, end_value, owner))
+        intervals.sort()
+        self.__starts = array(RANGE_DATA_TYPECODE, (i[0] for i in intervals))
+        self.__ends = array(RANGE_DATA_TYPECODE, (i[1] for i in intervals))
+        self.__owners = array('L', (i[2] for i in intervals))
+        # Implicit segment tree holding the max end of each subtree.
+        leaf_count = 1
+        while leaf_count < len(intervals):
+            leaf_count <<= 1
+        tree = array(RANGE_DATA_TYPECODE, [0]) * (leaf_count * 2)
+        tree[leaf_count:leaf_count + len(intervals)] = self.__ends
+        for node in range(leaf_count - 1, 0, -1):
+            tree[node] = max(tree[node * 2], tree[node * 2 + 1])
+        self.__tree = tree
+        self.__leaf_count = leaf_count
+
+    def __iter_overlaps(self, blocks):
+        """
+        Yield (owner, start, end) for every indexed range overlapping
+        blocks, clipped to blocks, in block order.
+        """
+        starts, ends, owners = self.__starts, self.__ends, self.__owners
+        tree, leaf_count = self.__tree, self.__leaf_count
+        for query_start, query_end in blocks:
+            # Only ranges starting before query_end can overlap.
+            limit = bisect.bisect_left(starts, query_end)
+            hits = []
+            stack = [(1, 0, leaf_count)]
+            while stack:
+                node, low, width = stack.pop()
+                if low >= limit or tree[node] <= query_start:
+                    continue
+                if node >= leaf_count:
+                    start_value = max(starts[low], query_start)
+                    hits.append((start_value, owners[low],
+                                 min(ends[low], query_end)))
+                    continue
+                width >>= 1
+                stack.append((node * 2 + 1, low + width, width))
+                stack.append((node * 2, low, width))
+            hits.sort()
+            for start_value, owner, end_value in hits:
+                yield owner, start_value, end_value
+
+    def get_overlap_sizes(self, blocks):
+        """
+        Obtain the keys overlapping blocks and the number of shared blocks,
+        ordered by the first shared block.
+        :param blocks: BlocksManager to query
+        :return: OrderedDict of key -> overlapped block count
+        """
+        result = OrderedDict()
+        for owner, start_value, end_value in self.__iter_overlaps(blocks):
+            key = self.keys[owner]
+            result[key] = result.get(key, 0) + end_value - start_value
+        return result
+
+    def get_overlap_blocks(self, blocks):
+        """
+        Obtain the keys overlapping blocks and the shared blocks.
+        :param blocks: BlocksManager to query
+        :return: OrderedDict of key -> BlocksManager of the shared blocks
+        """
+        pieces = OrderedDict()
+        for owner, start_value, end_value in self.__iter_overlaps(blocks):
+            key = self.keys[owner]
+            pieces.setdefault(key, []).extend((start_value, end_value))
+        return OrderedDict(
+            (key, BlocksManager(range_data=data))
+            for key, data in pieces.items())
@@ -58,9 +58,12 @@ import patch_package_process
 import math
 
 
+from blocks_manager import BlockBitmap
+from blocks_manager import BlocksManager
 from gigraph_process import GigraphProcess
 from image_class import FullUpdateImage
 from image_class import IncUpdateImage
+from image_class import StagedImage
 from transfers_manager import TransfersManager
 from log_exception import UPDATE_LOGGER
 from script_generator import PreludeScript
@@ -80,7 +83,6 @@ from utils import get_update_info
 from utils import SCRIPT_KEY_LIST
 from utils import PER_BLOCK_SIZE
 from utils import E2FSDROID_PATH
-from utils import MAXIMUM_RECURSION_DEPTH
 from utils import VERSE_SCRIPT_EVENT
 from utils import INC_IMAGE_EVENT
 from utils import DIFF_EXE_PATH
@@ -89,9 +91,6 @@ from utils import DECOUPLED_EVENT
 from utils import get_update_config_softversion
 from vendor_script import create_vendor_script_class
 from create_chunk import CreateChunk
-from concurrent.futures import ThreadPoolExecutor
-
-sys.setrecursionlimit(MAXIMUM_RECURSION_DEPTH)
 
 
 def type_check(arg):
@@ -225,6 +224,25 @@ def create_entrance_args():
     parser.add_argument("-ab", "--ab_partition_update", action='store_true',
                         help="Ab partition update mode, "
                              "Create update package for ab partition update.")
+    parser.add_argument("-icd", "--image_cache_dir", default=None,
+                        help="Image cache mode, "
+                             "Directory caching the parse result of "
+                             "incremental images.")
+    parser.add_argument("-ics", "--image_cache_size", type=int, default=4096,
+                        help="Maximum size of the image cache in MiB.")
+    parser.add_argument("-sm", "--similarity_match", action='store_true',
+                        help="Similarity match mode, "
+                             "Diff renamed files against the most similar "
+                             "source file.")
+    parser.add_argument("-spb", "--split_piece_blocks", type=int,
+                        default=0,
+                        help="Split mode, "
+                             "Number of blocks in a piece of large diff "
+                             "files diffed in parallel, "
+                             "0 (default) disables splitting.")
+    parser.add_argument("-stb", "--stash_budget", type=int, default=None,
+                        help="Maximum size of the stashed blocks on the "
+                             "device in MiB.")
 
 
 def parse_args():
@@ -243,6 +261,11 @@ def parse_args():
     OPTIONS_MANAGER.sd_card = args.sd_card
     OPTIONS_MANAGER.stream_update = args.stream_update
     OPTIONS_MANAGER.ab_partition_update = args.ab_partition_update
+    OPTIONS_MANAGER.image_cache_dir = args.image_cache_dir
+    OPTIONS_MANAGER.image_cache_size = args.image_cache_size
+    OPTIONS_MANAGER.similarity_match = args.similarity_match
+    OPTIONS_MANAGER.split_piece_blocks = args.split_piece_blocks
+    OPTIONS_MANAGER.stash_budget = args.stash_budget
 
 
 def get_args():
@@ -594,14 +617,11 @@ def increment_image_diff_processing(
         script_check_cmd_list, script_write_cmd_list, verse_script)
 
 
-def copy_in_ab_process(patch_process, src_image_class, need_copy_blocks,
-                       non_continuous_blocks, each_img):
+def copy_in_ab_process(patch_process, src_image_class, each_img):
     """
     Handle the process of copying blocks in an AB partition during an update.
     :param patch_process: The patch process object responsible for managing the update.
     :param src_image_class: The source image class containing metadata about the image.
-    :param need_copy_blocks: A list to store blocks that need to be copied.
-    :param non_continuous_blocks: A list to store blocks that are non-continuous.
     :param each_img: The current image being processed.
     :return:
     """
@@ -614,28 +634,15 @@ def copy_in_ab_process(patch_process, src_image_class, need_copy_blocks,
         no_copy_blocks_in_ab, transfer_content_no_startoffert = parse_transfer_content(transfer_content)
         
         # Find the blocks to copy, total blocks includeing zero, excluding total_blocks
-        no_copy_blocks_set = set(no_copy_blocks_in_ab)
-        
-        def process_block(src_block):
-            if src_block in no_copy_blocks_set:
-                return None, src_block  # Not to copy
-            return src_block, None  # To copy
-        with ThreadPoolExecutor() as executor:
-            results = executor.map(process_block, range(src_image_class.total_blocks))
-
-        for to_copy, not_to_copy in results:
-            if to_copy is not None:
-                need_copy_blocks.append(to_copy)
-            if not_to_copy is not None:
-                non_continuous_blocks.append(not_to_copy)
-        # Sort blocks consecutively
-        if len(need_copy_blocks):
-            group_numbers_list = group_numbers(need_copy_blocks)
-        else:
-            group_numbers_list = []
+        no_copy_bitmap = BlockBitmap.from_block_numbers(
+            no_copy_blocks_in_ab, src_image_class.total_blocks)
+        need_copy_ranges = no_copy_bitmap.get_complement().to_blocks()
+        # The copy ranges come out of the bitmap sorted and merged
+        group_numbers_list = list(need_copy_ranges.range_view())
+        if not group_numbers_list:
             print(f'there is no copy blocks in image {each_img} !')
         # Add the copy command for ab partition synchronization
-        transfer_content = patch_process.add_ab_copy_content(len(need_copy_blocks), 
+        transfer_content = patch_process.add_ab_copy_content(need_copy_ranges.size(), 
                                                         group_numbers_list, transfer_content_no_startoffert)
         OPTIONS_MANAGER.image_transfer_dict_contents[each_img] = transfer_content
         OPTIONS_MANAGER.image_patch_dic[each_img] = chunk_pkgdiff_list
@@ -680,9 +687,6 @@ def increment_image_processing(
         each_tgt_image_path = os.path.join(target_package_dir, '%s.img' % each_img)
         each_tgt_map_path = os.path.join(target_package_dir, '%s.map' % each_img)
 
-        # This will store tuples of (start, end, length) for continuous ranges
-        non_continuous_blocks = []
-        need_copy_blocks = []
         check_make_map_path(each_img)
 
         # Call the new function to process image maps
@@ -712,6 +716,8 @@ def increment_image_processing(
 
         transfers_manager = TransfersManager(each_img, tgt_image_class, src_image_class)
         transfers_manager.find_process_needs()
+        transfers_manager.split_large_actions(
+            OPTIONS_MANAGER.split_piece_blocks)
         actions_list = transfers_manager.get_action_list()
             
         graph_process = GigraphProcess(actions_list, src_image_class, tgt_image_class)
@@ -725,11 +731,15 @@ def increment_image_processing(
         patch_process.patch_process(each_tgt_image_path)
         
         # Add copy command for ab partition
-        copy_in_ab_process(patch_process, src_image_class, need_copy_blocks,
-                       non_continuous_blocks, each_img)
+        copy_in_ab_process(patch_process, src_image_class, each_img)
             
         patch_process.write_script(each_img, script_check_cmd_list, script_write_cmd_list, verse_script)
         OPTIONS_MANAGER.incremental_block_file_obj_dict[each_img] = patch_process.package_patch_zip
+        if not inc_image:
+            src_image_class.close()
+            tgt_image_class.close()
+        # Memoized set operations only pay off within one image.
+        BlocksManager.clear_memo()
         if not OPTIONS_MANAGER.stream_update:
             if not check_patch_file(patch_process):
                 UPDATE_LOGGER.print_log('Verify the incremental result failed!', UPDATE_LOGGER.ERROR_LOG)
@@ -741,16 +751,15 @@ def increment_image_processing(
 
 def get_large_of_target_image(each_tgt_image_path, each_img):
     """
-    Reads the target image content and stores it in OPTIONS_MANAGER.diff_image_new_data.
+    Records the target image in OPTIONS_MANAGER.diff_image_new_data, its data is read lazily.
 
     :param each_tgt_image_path: The path to the target image.
     :param each_img: The name of the image (without extension).
     :return: True if successful, False otherwise.
     """
     try:
-        with open(each_tgt_image_path, 'rb') as f:
-            target_content = f.read()
-        OPTIONS_MANAGER.diff_image_new_data[each_img] = target_content
+        OPTIONS_MANAGER.diff_image_new_data[each_img] = \
+            StagedImage(each_tgt_image_path)
         return True
     except Exception as e:
         print(f"Error reading target image {each_img}: {e}")
@@ -809,9 +818,8 @@ def handle_no_map_generation(each_img, each_src_image_path, each_tgt_image_path,
             "the component: %s cannot be full update processed. " %
             each_tgt_image_path)
             return False
-        with open(each_tgt_image_path, 'rb') as f:
-            tartget_no_map_content = f.read()
-        chunk, block_sets = split_image_file(each_img, tartget_no_map_content)
+        chunk, block_sets = split_image_file(
+            each_img, StagedImage(each_tgt_image_path))
         OPTIONS_MANAGER.image_chunk[each_img] = chunk
         OPTIONS_MANAGER.image_block_sets[each_img] = block_sets
         return True
@@ -933,42 +941,6 @@ def unpack_package_processing():
         sys.exit(0)
 
 
-def group_numbers(arr):
-    """
-    Groups and sorts a list of consecutive numbers, returning a list of block ranges.
-    :param arr: A list of integers representing block numbers.
-    :return: A list of integers representing the start and end of each block range.
-    """
-    result = []
-    current_group = [arr[0]]
-    transfer_content_blocks = []
-    
-    for i in range(1, len(arr)):
-        if arr[i] == arr[i - 1] + 1:
-            current_group.append(arr[i])
-        else:
-            result.append({
-                'min': min(current_group),
-                'max': max(current_group),
-                'length': len(current_group)
-            })
-            transfer_content_blocks.append(min(current_group))
-            transfer_content_blocks.append(max(current_group) + 1)
-            
-            current_group = [arr[i]]
-    
-           
-    result.append({
-        'min': min(current_group),
-        'max': max(current_group),
-        'length': len(current_group)
-    })
-    transfer_content_blocks.append(min(current_group))
-    transfer_content_blocks.append(max(current_group) + 1)
-    
-    return transfer_content_blocks
-
-
 def parse_transfer_content(content):
     """
     Parses the transfer content to extract block information and modified lines.   
@@ -1078,11 +1050,14 @@ def split_image_file(each_img, full_image_data):
     """
     Splits the full image data into smaller chunks.    
     :param each_img: The image to be split (not used in the current implementation).
-    :param full_image_data: The complete image data to be split.
+    :param full_image_data: The complete image data, or a StagedImage whose chunks are
+                            memoryview slices read lazily from the image file.
     :return: A tuple containing two lists:
              - chunks: A list of data chunks.
              - block_sets: A list of corresponding block sets for each chunk.
     """
+    if isinstance(full_image_data, StagedImage):
+        full_image_data = full_image_data.get_view()
     # get the total block number of the image
     total_blocks = math.ceil(len(full_image_data) / 4096)
     print(f'total tgt blocks:{total_blocks}')
@@ -13,12 +13,23 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import heapq
+from array import array
 from collections import OrderedDict
 
+from blocks_manager import BlocksManager
+from blocks_manager import BlocksOverlapIndex
+from blocks_manager import iter_overlap_pairs
 from log_exception import UPDATE_LOGGER
+from transfers_manager import ActionType
+from utils import FILE_MAP_ZERO_KEY
+from utils import OPTIONS_MANAGER
+from utils import PER_BLOCK_SIZE
 
 # 50% of the data partition, in KB x 1024.
 DATA_SIZE = 1374024 * 1024
+# Components up to this many actions are ordered exactly.
+EXACT_ORDER_SIZE = 10
 
 
 class GigraphProcess(object):
@@ -30,7 +41,10 @@ class GigraphProcess(object):
         self.src_img_obj = src_image
         self.tgt_img_obj = tgt_image
         self.vertices = len(self.actions_list)
-        self.data_size = DATA_SIZE
+        self.data_size = DATA_SIZE \
+            if OPTIONS_MANAGER.stash_budget is None else \
+            OPTIONS_MANAGER.stash_budget * 1024 * 1024
+        self.max_stash_blocks = 0
 
         self.generate_digraph()
 
@@ -38,149 +52,547 @@ class GigraphProcess(object):
         """
         Start correlation lookup.
         """
-        source_ranges = []
-        source_ranges = \
-            self.get_source_ranges(self.actions_list, source_ranges)
-
-        self.get_intersections_dict(source_ranges)
+        self.action_graph = self.get_intersections_dict()
         # Start ordering.
-        topo_logical = TopoLogical(self)
-        action_stack = topo_logical.stack()
+        stash_order = StashOrder(self)
+        action_stack = stash_order.stack()
+        UPDATE_LOGGER.print_log(
+            "Action order stashes %d blocks!" % stash_order.stash_cost)
         new_action_list = []
         for action in action_stack:
             action.order = len(new_action_list)
             new_action_list.append(action)
         self.actions_list = new_action_list
 
-    def get_intersections_dict(self, source_ranges):
+    def get_intersections_dict(self):
         """
-        Get the intersections_dict.
-        :param source_ranges: source blocks
-        :return:
+        Get the intersections of all actions, sweeping the src ranges and
+        the tgt ranges in one pass. An action whose src overlaps the tgt of
+        another goes before it, weighted by the overlapped block count.
+        :return: ActionGraph of the actions
         """
-        for each_action in self.actions_list:
+        overlaps_list = [[] for _ in self.actions_list]
+        for src_idx, tgt_idx, start, end in iter_overlap_pairs(
+                [each_action.src_block_set
+                 for each_action in self.actions_list],
+                [each_action.tgt_block_set
+                 for each_action in self.actions_list]):
+            overlaps_list[tgt_idx].append((start, src_idx, end))
+        edge_parents = array('L')
+        edge_children = array('L')
+        edge_weights = array('Q')
+        for tgt_idx, overlaps in enumerate(overlaps_list):
+            # Order the intersections by the first shared block.
+            overlaps.sort()
             intersections = OrderedDict()
-            for start_value, end_value in each_action.tgt_block_set:
-                for i in range(start_value, end_value):
-                    if i >= len(source_ranges):
-                        break
-                    if source_ranges[i] is not None:
-                        for j in source_ranges[i]:
-                            intersections[j] = None
-
-            self.update_goes_before_and_after(each_action, intersections)
-
-    @staticmethod
-    def update_goes_before_and_after(each_action, intersections):
-        """
-        Update "goes before" and "goes after".
-        :param each_action: action to be processed
-        :param intersections: intersections dict
-        :return:
-        """
-        for each_intersection in intersections:
-            if each_action is each_intersection:
-                continue
-
-            intersect_range = \
-                each_action.tgt_block_set.get_intersect_with_other(
-                    each_intersection.src_block_set)
-            if intersect_range:
-                if each_intersection.src_name == "__ZERO":
-                    size = 0
-                else:
-                    size = intersect_range.size()
-                each_intersection.child[each_action] = size
-                each_action.parent[each_intersection] = size
-
-    @staticmethod
-    def get_source_ranges(transfers, source_ranges):
-        """
-        Update "goes before" and "goes after".
-        :param transfers: actions list
-        :param source_ranges: source blocks
-        :return:
-        """
-        for each_action in transfers:
-            for start_value, end_value in each_action.src_block_set:
-                if end_value > len(source_ranges):
-                    source_ranges.extend(
-                        [None] * (end_value - len(source_ranges)))
-                for i in range(start_value, end_value):
-                    if source_ranges[i] is None:
-                        source_ranges[i] = \
-                            OrderedDict.fromkeys([each_action])
-                    else:
-                        source_ranges[i][each_action] = None
-        return source_ranges
+            for start, src_idx, end in overlaps:
+                if src_idx != tgt_idx:
+                    intersections[src_idx] = \
+                        intersections.get(src_idx, 0) + end - start
+            for src_idx, intersect_size in intersections.items():
+                edge_parents.append(src_idx)
+                edge_children.append(tgt_idx)
+                edge_weights.append(
+                    0 if self.actions_list[src_idx].src_name ==
+                    FILE_MAP_ZERO_KEY
+                    else intersect_size)
+        return ActionGraph(self.actions_list, edge_parents, edge_children,
+                           edge_weights)
 
     def stash_process(self):
         """
         Stash processing
         """
         UPDATE_LOGGER.print_log("Reversing backward edges...")
+        target_index = BlocksOverlapIndex(
+            (each_action, each_action.tgt_block_set)
+            for each_action in self.actions_list)
+        action_graph = self.action_graph
         stash_raw_id = 0
         for each_action in self.actions_list:
-            each_child_dict = each_action.child.copy()
-            for each_before in each_child_dict:
+            action_id = each_action.action_id
+            overlap_blocks = None
+            for edge in range(action_graph.child_offsets[action_id],
+                              action_graph.child_offsets[action_id + 1]):
+                each_before = \
+                    action_graph.actions_list[action_graph.child_ids[edge]]
                 if each_action.order >= each_before.order:
-                    intersect_block_set = \
-                        each_action.src_block_set.get_intersect_with_other(
-                            each_before.tgt_block_set)
+                    action_graph.edge_reversed[edge] = 1
+                    # A ZERO action does not read its src blocks, its
+                    # edges weigh 0 and nothing is stashed for them.
+                    if each_action.src_name == FILE_MAP_ZERO_KEY:
+                        continue
+                    if overlap_blocks is None:
+                        # Stashes are mapped into sorted src blocks, src
+                        # matched by content may be in target order.
+                        if not each_action.src_block_set.monotonic:
+                            each_action.src_block_set = \
+                                BlocksManager.union_all(
+                                    [each_action.src_block_set])
+                        overlap_blocks = target_index.get_overlap_blocks(
+                            each_action.src_block_set)
+                    intersect_block_set = overlap_blocks.get(
+                        each_before, BlocksManager())
 
                     each_before.stash_before.append(
                         (stash_raw_id, intersect_block_set))
                     each_action.use_stash.append(
                         (stash_raw_id, intersect_block_set))
                     stash_raw_id += 1
-                    each_action.child.pop(each_before)
-                    each_before.parent.pop(each_action)
-                    each_action.parent[each_before] = None
-                    each_before.child[each_action] = None
         UPDATE_LOGGER.print_log("Reversing backward edges completed!")
+        self.revise_stash_size()
+
+    def revise_stash_size(self):
+        """
+        Walk the actions in order, tracking the blocks stashed on the
+        device. When a stash would exceed data_size, the actions behind
+        the largest stashes are converted to NEW until it fits.
+        """
+        budget_blocks = self.data_size // PER_BLOCK_SIZE
+        stash_map = {}
+        for each_action in self.actions_list:
+            for stash_raw_id, stash_block_set in each_action.stash_before:
+                stash_map[stash_raw_id] = [each_action, None,
+                                           stash_block_set]
+        for each_action in self.actions_list:
+            for stash_raw_id, _ in each_action.use_stash:
+                stash_map[stash_raw_id][1] = each_action
 
+        # Stashes held at the current action, and a heap to find the
+        # largest, entries of freed stashes are skipped when popped.
+        stashed = {}
+        stashed_heap = []
+        stashed_blocks = 0
+        new_blocks = 0
 
-class DirectedCycle(object):
-    def __init__(self, graph):
-        self.graph = graph
-        self.marked = [False for _ in range(self.graph.vertices)]
-        self.has_cycle = False
-        self.ontrack = [False for _ in range(self.graph.vertices)]
+        def convert_to_new(action):
+            nonlocal stashed_blocks, new_blocks
+            for stash_raw_id, stash_block_set in action.use_stash:
+                stash_action = stash_map[stash_raw_id][0]
+                stash_action.stash_before.remove(
+                    (stash_raw_id, stash_block_set))
+                stashed_blocks -= stashed.pop(stash_raw_id, 0)
+            action.use_stash = []
+            if action.type_str == ActionType.DIFFERENT:
+                action.type_str = ActionType.NEW
+                action.src_block_set = BlocksManager()
+                new_blocks += action.tgt_block_set.size()
+
+        def make_room(need_blocks):
+            # Free the stashes larger than need_blocks first, return False
+            # if need_blocks itself is the largest to give up.
+            while stashed_blocks + need_blocks > budget_blocks:
+                while stashed_heap and \
+                        stashed_heap[0][1] not in stashed:
+                    heapq.heappop(stashed_heap)
+                if not stashed_heap or -stashed_heap[0][0] <= need_blocks:
+                    return False
+                _, stash_raw_id = heapq.heappop(stashed_heap)
+                convert_to_new(stash_map[stash_raw_id][1])
+            return True
+
+        for each_action in self.actions_list:
+            for stash_raw_id, stash_block_set in \
+                    list(each_action.stash_before):
+                if (stash_raw_id, stash_block_set) not in \
+                        each_action.stash_before:
+                    continue
+                use_action = stash_map[stash_raw_id][1]
+                if make_room(stash_block_set.size()):
+                    stashed[stash_raw_id] = stash_block_set.size()
+                    stashed_blocks += stash_block_set.size()
+                    heapq.heappush(stashed_heap,
+                                   (-stash_block_set.size(), stash_raw_id))
+                else:
+                    convert_to_new(use_action)
+            # A diff reading its own target blocks holds its source too.
+            if each_action.type_str == ActionType.DIFFERENT and \
+                    each_action.src_block_set.is_overlaps(
+                        each_action.tgt_block_set) and \
+                    not make_room(each_action.src_block_set.size()):
+                convert_to_new(each_action)
+            for stash_raw_id, _ in each_action.use_stash:
+                stashed_blocks -= stashed.pop(stash_raw_id, 0)
+
+        self.max_stash_blocks = self.get_max_stash_blocks()
+        if new_blocks:
+            UPDATE_LOGGER.print_log(
+                "Stash budget of %d blocks exceeded, %d blocks "
+                "are written as NEW!" % (budget_blocks, new_blocks),
+                UPDATE_LOGGER.WARNING_LOG)
+        UPDATE_LOGGER.print_log(
+            "Max stash: %d blocks!" % self.max_stash_blocks)
+
+    def get_max_stash_blocks(self):
+        """
+        Get the high-water mark of the stashed blocks on the device.
+        :return: max stashed block count
+        """
+        stash_size = {}
+        stashed_blocks = 0
+        max_stash_blocks = 0
+        for each_action in self.actions_list:
+            for stash_raw_id, stash_block_set in each_action.stash_before:
+                stash_size[stash_raw_id] = stash_block_set.size()
+                stashed_blocks += stash_block_set.size()
+            max_stash_blocks = max(max_stash_blocks, stashed_blocks)
+            if each_action.type_str == ActionType.DIFFERENT and \
+                    each_action.src_block_set.is_overlaps(
+                        each_action.tgt_block_set):
+                max_stash_blocks = max(
+                    max_stash_blocks,
+                    stashed_blocks + each_action.src_block_set.size())
+            for stash_raw_id, _ in each_action.use_stash:
+                stashed_blocks -= stash_size.pop(stash_raw_id)
+        return max_stash_blocks
+
+
+class ActionGraph(object):
+    """
+    The child/parent edges of the actions by action id, the index of the
+    action in actions_list, as CSR arrays. An action goes before its
+    children. ActionInfo.child and ActionInfo.parent read their edges
+    from here once the graph is built.
+    """
+
+    def __init__(self, actions_list, edge_parents, edge_children,
+                 edge_weights):
+        """
+        :param actions_list: actions, in action id order
+        :param edge_parents: parent id of each edge
+        :param edge_children: child id of each edge, the edges are grouped
+                              by child id in ascending order
+        :param edge_weights: weight of each edge
+        """
+        self.actions_list = list(actions_list)
+        action_count = len(self.actions_list)
+        for action_id, each_action in enumerate(self.actions_list):
+            each_action.graph = self
+            each_action.action_id = action_id
+
+        # The edges are already grouped by child, the parent side is them.
+        self.parent_offsets = self.get_offsets(edge_children, action_count)
+        self.parent_ids = edge_parents
+        self.parent_weights = edge_weights
+        # The child side is sorted by parent, keeping the edge order.
+        self.child_offsets = self.get_offsets(edge_parents, action_count)
+        next_edge = self.child_offsets[:-1]
+        self.child_ids = array('L', bytes(len(edge_parents) *
+                                          array('L').itemsize))
+        self.child_weights = array('Q', bytes(len(edge_parents) * 8))
+        # Child side position of each parent side edge.
+        self.parent_child_edge = array('L', self.child_ids)
+        for edge, parent_id in enumerate(edge_parents):
+            child_edge = next_edge[parent_id]
+            next_edge[parent_id] += 1
+            self.child_ids[child_edge] = edge_children[edge]
+            self.child_weights[child_edge] = edge_weights[edge]
+            self.parent_child_edge[edge] = child_edge
+        # Child side edges turned into stashes by stash_process.
+        self.edge_reversed = bytearray(len(edge_parents))
 
+    @staticmethod
+    def get_offsets(edge_ids, action_count):
+        offsets = array('L', bytes((action_count + 1) * array('L').itemsize))
+        for action_id in edge_ids:
+            offsets[action_id + 1] += 1
+        for action_id in range(action_count):
+            offsets[action_id + 1] += offsets[action_id]
+        return offsets
+
+    def get_child_edges(self, action_id):
+        start, end = self.child_offsets[action_id], \
+            self.child_offsets[action_id + 1]
+        return zip(self.child_ids[start:end], self.child_weights[start:end])
+
+    def get_parent_edges(self, action_id):
+        start, end = self.parent_offsets[action_id], \
+            self.parent_offsets[action_id + 1]
+        return zip(self.parent_ids[start:end], self.parent_weights[start:end])
+
+    def get_child_dict(self, action_id):
+        """
+        Get the children of an action as a new OrderedDict of action ->
+        weight. Reversed edges map to None.
+        """
+        child_dict = OrderedDict()
+        for edge in range(self.child_offsets[action_id],
+                          self.child_offsets[action_id + 1]):
+            if not self.edge_reversed[edge]:
+                child_dict[self.actions_list[self.child_ids[edge]]] = \
+                    self.child_weights[edge]
+        for edge in range(self.parent_offsets[action_id],
+                          self.parent_offsets[action_id + 1]):
+            if self.edge_reversed[self.parent_child_edge[edge]]:
+                child_dict[self.actions_list[self.parent_ids[edge]]] = None
+        return child_dict
+
+    def get_parent_dict(self, action_id):
+        """
+        Get the parents of an action as a new OrderedDict of action ->
+        weight. Reversed edges map to None.
+        """
+        parent_dict = OrderedDict()
+        for edge in range(self.parent_offsets[action_id],
+                          self.parent_offsets[action_id + 1]):
+            if not self.edge_reversed[self.parent_child_edge[edge]]:
+                parent_dict[self.actions_list[self.parent_ids[edge]]] = \
+                    self.parent_weights[edge]
+        for edge in range(self.child_offsets[action_id],
+                          self.child_offsets[action_id + 1]):
+            if self.edge_reversed[edge]:
+                parent_dict[self.actions_list[self.child_ids[edge]]] = None
+        return parent_dict
+
+
+class StashOrder(object):
+    """
+    Order the actions so that the blocks stashed for the edges going
+    backwards are as few as possible. The strongly connected components
+    are ordered topologically, so only the edges inside a component can
+    go backwards. Small components are ordered exactly, larger ones with
+    the greedy heuristic of Eades, Lin and Smyth for the feedback arc
+    set, with the overlap sizes as edge weights.
+    """
 
-class DepthFirstOrder:
     def __init__(self, graph):
-        self.graph = graph
-        self.marked = {}
-        self.stack = []
-
-        for each_action in self.graph.actions_list:
-            self.marked[each_action] = False
-
-    def dfs(self):
-        def dfs(index):
-            self.marked[index] = True
-            for each_child in index.child:
-                if not self.marked[each_child]:
-                    dfs(each_child)
-            self.stack.insert(0, index)
-
-        for each_action in self.graph.actions_list:
-            if not self.marked[each_action]:
-                dfs(each_action)
-        return self.stack
+        self.action_graph = graph.action_graph
+        self.actions_list = self.action_graph.actions_list
+        self.order = []
+        self.stash_cost = 0
+        self.sort_vertices()
+
+    def get_children(self, index):
+        return self.action_graph.child_ids[
+            self.action_graph.child_offsets[index]:
+            self.action_graph.child_offsets[index + 1]]
+
+    def get_components(self):
+        """
+        Find the strongly connected components with Tarjan's algorithm,
+        iteratively.
+        :return: component list, component id of each action
+        """
+        action_count = len(self.actions_list)
+        child_offsets = self.action_graph.child_offsets
+        child_ids = self.action_graph.child_ids
+        visit_index = [-1] * action_count
+        low_link = [0] * action_count
+        on_stack = [False] * action_count
+        component_id = [-1] * action_count
+        components = []
+        stack = []
+        counter = 0
+        for root in range(action_count):
+            if visit_index[root] != -1:
+                continue
+            visit_index[root] = low_link[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, child_offsets[root])]
+            while work:
+                index, edge = work[-1]
+                if edge < child_offsets[index + 1]:
+                    work[-1] = (index, edge + 1)
+                    child_index = child_ids[edge]
+                    if visit_index[child_index] == -1:
+                        visit_index[child_index] = low_link[child_index] = \
+                            counter
+                        counter += 1
+                        stack.append(child_index)
+                        on_stack[child_index] = True
+                        work.append((child_index,
+                                     child_offsets[child_index]))
+                    elif on_stack[child_index]:
+                        low_link[index] = min(low_link[index],
+                                              visit_index[child_index])
+                    continue
+                work.pop()
+                if work:
+                    parent_index = work[-1][0]
+                    low_link[parent_index] = min(low_link[parent_index],
+                                                 low_link[index])
+                if low_link[index] != visit_index[index]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component_id[member] = len(components)
+                    component.append(member)
+                    if member == index:
+                        break
+                components.append(sorted(component))
+        return components, component_id
 
     def sort_vertices(self):
-        return self.dfs()
+        components, component_id = self.get_components()
+        # Order the components topologically, keeping the original
+        # order of the actions where the edges allow it.
+        in_degree = [0] * len(components)
+        component_children = [set() for _ in components]
+        for index in range(len(self.actions_list)):
+            for child_index in self.get_children(index):
+                child_component = component_id[child_index]
+                if child_component != component_id[index] and \
+                        child_component not in \
+                        component_children[component_id[index]]:
+                    component_children[component_id[index]].add(
+                        child_component)
+                    in_degree[child_component] += 1
+        heap = [(component[0], component_index)
+                for component_index, component in enumerate(components)
+                if in_degree[component_index] == 0]
+        heapq.heapify(heap)
+        order = []
+        while heap:
+            _, component_index = heapq.heappop(heap)
+            order.extend(self.order_component(components[component_index]))
+            for child_component in component_children[component_index]:
+                in_degree[child_component] -= 1
+                if in_degree[child_component] == 0:
+                    heapq.heappush(heap, (components[child_component][0],
+                                          child_component))
 
+        self.order = [self.actions_list[index] for index in order]
+        self.stash_cost = self.get_stash_cost(self.order)
+        return self.order
 
-class TopoLogical(object):
-    def __init__(self, graph):
-        self.order = None
-        self.cycle = DirectedCycle(graph)
-        if not self.cycle.has_cycle:
-            dfo = DepthFirstOrder(graph)
-            self.order = dfo.sort_vertices()
+    def order_component(self, component):
+        if len(component) == 1:
+            return component
+        if len(component) <= EXACT_ORDER_SIZE:
+            return self.get_exact_order(component)
+        return self.get_greedy_order(component)
+
+    def get_exact_order(self, component):
+        """
+        Order a small component with the least backward weight, by dynamic
+        programming over the subsets of the actions placed first.
+        """
+        position = {index: pos for pos, index in enumerate(component)}
+        # Child bits and weights of the edges inside the component.
+        child_weights = [[] for _ in component]
+        for pos, index in enumerate(component):
+            for child_index, weight in \
+                    self.action_graph.get_child_edges(index):
+                if child_index in position:
+                    child_weights[pos].append(
+                        (1 << position[child_index], weight))
+        full_mask = (1 << len(component)) - 1
+        cost = [None] * (full_mask + 1)
+        last = [0] * (full_mask + 1)
+        cost[0] = 0
+        for mask in range(full_mask + 1):
+            if cost[mask] is None:
+                continue
+            for pos in range(len(component)):
+                if mask & (1 << pos):
+                    continue
+                next_cost = cost[mask] + sum(
+                    weight for bit, weight in child_weights[pos]
+                    if mask & bit)
+                next_mask = mask | (1 << pos)
+                if cost[next_mask] is None or next_cost < cost[next_mask]:
+                    cost[next_mask] = next_cost
+                    last[next_mask] = pos
+        order = []
+        mask = full_mask
+        while mask:
+            order.append(component[last[mask]])
+            mask &= ~(1 << last[mask])
+        order.reverse()
+        return order
+
+    def get_greedy_order(self, component):
+        """
+        Order a component with the Eades-Lin-Smyth heuristic. Sinks are
+        put at the end and sources at the front, otherwise the action with
+        the largest outgoing minus incoming weight goes next.
+        """
+        members = set(component)
+        # Edges inside the component, as (action id, weight) lists.
+        children = {index: [(child_index, weight) for child_index, weight in
+                            self.action_graph.get_child_edges(index)
+                            if child_index in members]
+                    for index in component}
+        parents = {index: [] for index in component}
+        for index in component:
+            for child_index, weight in children[index]:
+                parents[child_index].append((index, weight))
+        in_degree = {index: len(parents[index]) for index in component}
+        out_degree = {index: len(children[index]) for index in component}
+        score = {index: sum(weight for _, weight in children[index]) -
+                 sum(weight for _, weight in parents[index])
+                 for index in component}
+        removed = set()
+        sinks = [index for index in component if out_degree[index] == 0]
+        sources = [index for index in component if in_degree[index] == 0]
+        heap = [(-score[index], index) for index in component]
+        heapq.heapify(heap)
+        head_list = []
+        tail_list = []
+
+        def remove(index):
+            removed.add(index)
+            for parent_index, weight in parents[index]:
+                if parent_index in removed:
+                    continue
+                out_degree[parent_index] -= 1
+                score[parent_index] -= weight
+                heapq.heappush(heap, (-score[parent_index], parent_index))
+                if out_degree[parent_index] == 0:
+                    sinks.append(parent_index)
+            for child_index, weight in children[index]:
+                if child_index in removed:
+                    continue
+                in_degree[child_index] -= 1
+                score[child_index] += weight
+                heapq.heappush(heap, (-score[child_index], child_index))
+                if in_degree[child_index] == 0:
+                    sources.append(child_index)
+
+        while len(removed) < len(component):
+            while sinks:
+                index = sinks.pop()
+                if index not in removed:
+                    tail_list.append(index)
+                    remove(index)
+            while sources:
+                index = sources.pop()
+                if index not in removed:
+                    head_list.append(index)
+                    remove(index)
+            if sinks or len(removed) == len(component):
+                continue
+            # Skip the stale entries left by the score updates.
+            while True:
+                neg_score, index = heapq.heappop(heap)
+                if index not in removed and -neg_score == score[index]:
+                    break
+            head_list.append(index)
+            remove(index)
+
+        head_list.extend(reversed(tail_list))
+        return head_list
+
+    @staticmethod
+    def get_stash_cost(order):
+        """
+        Get the number of blocks stash_process stashes for the order.
+        :param order: ordered action list
+        :return: stashed block count
+        """
+        position = {each_action.action_id: index
+                    for index, each_action in enumerate(order)}
+        stash_cost = 0
+        for each_action in order:
+            for child_id, weight in \
+                    each_action.graph.get_child_edges(each_action.action_id):
+                if position[child_id] <= position[each_action.action_id]:
+                    stash_cost += weight
+        return stash_cost
 
     def stack(self):
         return self.order
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Description : on-disk cache of the parsed state of incremental images
+"""
+import os
+import struct
+import tempfile
+from array import array
+from hashlib import sha256
+
+from blocks_manager import BlocksManager
+from blocks_manager import RANGE_DATA_TYPECODE
+from log_exception import UPDATE_LOGGER
+
+IMAGE_CACHE_MAGIC = b"UPIC"
+IMAGE_CACHE_VERSION = 1
+IMAGE_CACHE_SUFFIX = ".cache"
+# magic, version, key digest, payload length
+IMAGE_CACHE_HEADER_FORMAT = "<4sI32sQ"
+# block size, total blocks, offset entries, file map entries
+IMAGE_CACHE_STATE_FORMAT = "<IQQQ"
+# chunk start, chunk length, file position, fill data, flags
+IMAGE_CACHE_OFFSET_FORMAT = "<QQQ4sB"
+OFFSET_HAS_FILE_POS = 1
+OFFSET_HAS_FILL_DATA = 2
+HASH_READ_SIZE = 1024 * 1024
+
+
+class ImageCache(object):
+    """
+    Cache the parse result of IncUpdateImage in cache_dir. Entries are
+    keyed by the image sha256 and size and the .map file sha256, and the
+    least recently used entries are removed above max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def get_file_sha256(file_path):
+        hash_obj = sha256()
+        with open(file_path, 'rb') as f_r:
+            for data in iter(lambda: f_r.read(HASH_READ_SIZE), b''):
+                hash_obj.update(data)
+        return hash_obj.hexdigest()
+
+    def get_key(self, image_path, map_path):
+        """
+        Get the cache key of an image and its .map file.
+        :param image_path: img file path
+        :param map_path: map file path
+        :return: key digest bytes
+        """
+        key_str = "%s:%d:%s" % (
+            self.get_file_sha256(image_path), os.path.getsize(image_path),
+            self.get_file_sha256(map_path))
+        return sha256(key_str.encode()).digest()
+
+    def get_cache_path(self, key):
+        return os.path.join(self.cache_dir, key.hex() + IMAGE_CACHE_SUFFIX)
+
+    def load(self, image, key):
+        """
+        Restore the parsed state of image from the cache.
+        :param image: IncUpdateImage whose state is restored
+        :param key: cache key from get_key
+        :return: True if the state was restored
+        """
+        cache_path = self.get_cache_path(key)
+        if not os.path.exists(cache_path):
+            return False
+        with open(cache_path, 'rb') as f_r:
+            content = f_r.read()
+        try:
+            state = self.decode(content, key)
+        except (struct.error, ValueError, RuntimeError,
+                UnicodeDecodeError) as error:
+            UPDATE_LOGGER.print_log(
+                "Discard invalid image cache %s: %s" % (cache_path, error),
+                UPDATE_LOGGER.WARNING_LOG)
+            os.remove(cache_path)
+            return False
+        image.block_size, image.total_blocks, image.care_block_range, \
+            image.extended_range, image.offset_value_list, \
+            image.file_map = state
+        image.offset_index = [i[0] for i in image.offset_value_list]
+        # The modification time orders the entries for eviction.
+        os.utime(cache_path)
+        return True
+
+    def store(self, image, key):
+        """
+        Write the parsed state of image to the cache, then evict.
+        :param image: parsed IncUpdateImage
+        :param key: cache key from get_key
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                dir=self.cache_dir, prefix="tmp-", delete=False) as w_f:
+            w_f.write(self.encode(image, key))
+        os.replace(w_f.name, self.get_cache_path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries above max_size bytes.
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(IMAGE_CACHE_SUFFIX):
+                file_stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append(
+                    (file_stat.st_mtime, file_stat.st_size, file_name))
+        total_size = sum(entry[1] for entry in entries)
+        for _, file_size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total_size -= file_size
+
+    @staticmethod
+    def encode_blocks(blocks):
+        data = blocks.range_view()
+        return struct.pack("<Q", len(data)) + data.tobytes()
+
+    @classmethod
+    def encode(cls, image, key):
+        """
+        Encode the parsed state of image.
+        """
+        content = [struct.pack(
+            IMAGE_CACHE_STATE_FORMAT, image.block_size, image.total_blocks,
+            len(image.offset_value_list), len(image.file_map)),
+            cls.encode_blocks(image.care_block_range),
+            cls.encode_blocks(image.extended_range)]
+        for chunk_start, chunk_len, file_pos, fill_data in \
+                image.offset_value_list:
+            flags = (OFFSET_HAS_FILE_POS if file_pos is not None else 0) | \
+                (OFFSET_HAS_FILL_DATA if fill_data is not None else 0)
+            content.append(struct.pack(
+                IMAGE_CACHE_OFFSET_FORMAT, chunk_start, chunk_len,
+                file_pos or 0, fill_data or b'', flags))
+        for file_name, blocks in image.file_map.items():
+            name_bytes = file_name.encode()
+            content.append(struct.pack("<I", len(name_bytes)) + name_bytes)
+            content.append(cls.encode_blocks(blocks))
+        payload = b''.join(content)
+        return struct.pack(IMAGE_CACHE_HEADER_FORMAT, IMAGE_CACHE_MAGIC,
+                           IMAGE_CACHE_VERSION, key, len(payload)) + \
+            payload + sha256(payload).digest()
+
+    @staticmethod
+    def decode(content, key):
+        """
+        Decode and validate an encoded state.
+        :return: block_size, total_blocks, care_block_range,
+                 extended_range, offset_value_list, file_map
+        """
+        header_size = struct.calcsize(IMAGE_CACHE_HEADER_FORMAT)
+        magic, version, content_key, payload_len = struct.unpack_from(
+            IMAGE_CACHE_HEADER_FORMAT, content)
+        payload = memoryview(content)[header_size:header_size + payload_len]
+        if magic != IMAGE_CACHE_MAGIC or version != IMAGE_CACHE_VERSION or \
+                content_key != key or \
+                len(content) != header_size + payload_len + 32 or \
+                sha256(payload).digest() != content[-32:]:
+            raise ValueError("header or digest mismatch")
+
+        pos = struct.calcsize(IMAGE_CACHE_STATE_FORMAT)
+        block_size, total_blocks, offset_count, file_count = \
+            struct.unpack_from(IMAGE_CACHE_STATE_FORMAT, payload)
+
+        def read_blocks():
+            nonlocal pos
+            value_count, = struct.unpack_from("<Q", payload, pos)
+            pos += 8
+            data = array(RANGE_DATA_TYPECODE)
+            data.frombytes(payload[pos:pos + value_count * data.itemsize])
+            pos += value_count * data.itemsize
+            return BlocksManager(range_data=data)
+
+        care_block_range = read_blocks()
+        extended_range = read_blocks()
+        offset_value_list = []
+        offset_size = struct.calcsize(IMAGE_CACHE_OFFSET_FORMAT)
+        for _ in range(offset_count):
+            chunk_start, chunk_len, file_pos, fill_data, flags = \
+                struct.unpack_from(IMAGE_CACHE_OFFSET_FORMAT, payload, pos)
+            pos += offset_size
+            offset_value_list.append((
+                chunk_start, chunk_len,
+                file_pos if flags & OFFSET_HAS_FILE_POS else None,
+                fill_data if flags & OFFSET_HAS_FILL_DATA else None))
+        file_map = {}
+        for _ in range(file_count):
+            name_len, = struct.unpack_from("<I", payload, pos)
+            pos += 4
+            file_name = bytes(payload[pos:pos + name_len]).decode()
+            pos += name_len
+            file_map[file_name] = read_blocks()
+        if pos != len(payload):
+            raise ValueError("trailing data")
+        return block_size, total_blocks, care_block_range, extended_range, \
+            offset_value_list, file_map
@@ -14,14 +14,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import bisect
-import copy
+import mmap
 import os
+import shutil
 import struct
 import tempfile
+import zlib
+from collections import OrderedDict
 from hashlib import sha256
 
 from log_exception import UPDATE_LOGGER
 from blocks_manager import BlocksManager
+from blocks_manager import clip_blocks_in_order
+from blocks_manager import read_block_map_file
+from image_cache import ImageCache
 from utils import OPTIONS_MANAGER
 from utils import EXTEND_VALUE
 from utils import FILE_MAP_ZERO_KEY
@@ -31,6 +37,69 @@ from utils import MAX_BLOCKS_PER_GROUP
 from utils import UPDATE_BIN_FILE_NAME
 from utils import FORBIDEN_UPDATE_IMAGE_SET
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of blocks classified per read when scanning for zero blocks.
+ZERO_SCAN_BLOCKS = 1024
+# Zero chunk of ZERO_SCAN_BLOCKS blocks for each block size scanned so far.
+ZERO_SCAN_CHUNKS = {}
+# Number of range digests remembered by each IncUpdateImage.
+RANGE_SHA256_CACHE_SIZE = 4096
+
+# Bytes copied per call when staging full images.
+STAGE_COPY_SIZE = 64 * 1024 * 1024
+
+# Android sparse image format.
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+SPARSE_HEADER_FORMAT = "<I4H4I"
+SPARSE_CHUNK_HEADER_FORMAT = "<2H2I"
+SPARSE_CHUNK_TYPE_RAW = 0xCAC1
+SPARSE_CHUNK_TYPE_FILL = 0xCAC2
+SPARSE_CHUNK_TYPE_DONT_CARE = 0xCAC3
+SPARSE_CHUNK_TYPE_CRC32 = 0xCAC4
+
+
+def scan_nonzero_blocks(image_view, start_block, end_block, block_size):
+    """
+    Find the nonzero blocks of [start_block, end_block) in an image.
+    :param image_view: memoryview of the raw image
+    :param start_block: first block to scan
+    :param end_block: block after the last one to scan
+    :param block_size: block size in bytes
+    :return: range data of the nonzero runs
+    """
+    nonzero_blocks = []
+    inside = False
+    zero_chunk = ZERO_SCAN_CHUNKS.get(block_size)
+    if zero_chunk is None:
+        zero_chunk = ZERO_SCAN_CHUNKS[block_size] = \
+            bytes(ZERO_SCAN_BLOCKS * block_size)
+    for chunk_start in range(start_block, end_block, ZERO_SCAN_BLOCKS):
+        chunk_blocks = min(ZERO_SCAN_BLOCKS, end_block - chunk_start)
+        chunk = image_view[chunk_start * block_size:
+                           (chunk_start + chunk_blocks) * block_size]
+        # zero_chunk starts with a buffer only if the buffer is all zero.
+        if zero_chunk.startswith(chunk):
+            flags = (False,) * chunk_blocks
+        elif numpy is not None:
+            flags = numpy.frombuffer(chunk, dtype=numpy.uint32).reshape(
+                -1, block_size // 4).any(axis=1).tolist()
+        else:
+            flags = [not zero_chunk.startswith(chunk[i:i + block_size])
+                     for i in range(0, len(chunk), block_size)]
+        if not inside and not any(flags):
+            continue
+        for idx, flag in enumerate(flags):
+            if flag != inside:
+                inside = flag
+                nonzero_blocks.append(chunk_start + idx)
+    if inside:
+        nonzero_blocks.append(end_block)
+    return nonzero_blocks
+
 
 class FullUpdateImage:
     """
@@ -57,10 +126,14 @@ class FullUpdateImage:
         full_image_file_obj_list = []
         full_image_content_len_list = []
         for idx, each_name in enumerate(self.full_img_list):
-            full_image_content = self.get_full_image_content(
-                self.full_image_path_list[idx])
+            each_image_path = self.full_image_path_list[idx]
             img_name = self.full_img_name_list[idx][:-4]
-            if full_image_content is False:
+            if not os.path.exists(each_image_path):
+                UPDATE_LOGGER.print_log(
+                    "The file is missing "
+                    "from the target package, "
+                    "the component: %s cannot be full update processed. " %
+                    each_image_path)
                 UPDATE_LOGGER.print_log(
                     "Get full image content failed!",
                     log_type=UPDATE_LOGGER.ERROR_LOG)
@@ -68,12 +141,12 @@ class FullUpdateImage:
             each_img = tempfile.NamedTemporaryFile(
                 dir=self.target_package_images_dir,
                 prefix="full_image%s" % img_name, mode='wb')
-            each_img.write(full_image_content)
-            each_img.seek(0)
-            full_image_content_len_list.append(len(full_image_content))
+            self.stage_image_file(each_image_path, each_img)
+            staged_image = StagedImage(each_img.name)
+            full_image_content_len_list.append(staged_image.size)
             full_image_file_obj_list.append(each_img)
             # 全量流式升级处理
-            OPTIONS_MANAGER.full_image_new_data[each_name] = full_image_content
+            OPTIONS_MANAGER.full_image_new_data[each_name] = staged_image
             
             UPDATE_LOGGER.print_log(
                 "Image %s full processing completed" % img_name)
@@ -90,6 +163,27 @@ class FullUpdateImage:
             len(self.full_img_list))
         return full_image_content_len_list, full_image_file_obj_list
 
+    @staticmethod
+    def stage_image_file(image_path, file_obj):
+        """
+        Copy the image into the staging file without passing it through
+        memory, copy_file_range lets the file system share the extents.
+        :param image_path: image file path
+        :param file_obj: staging file object
+        """
+        with open(image_path, 'rb') as f_r:
+            try:
+                while os.copy_file_range(
+                        f_r.fileno(), file_obj.fileno(), STAGE_COPY_SIZE):
+                    pass
+            except (AttributeError, OSError):
+                f_r.seek(0)
+                file_obj.seek(0)
+                file_obj.truncate()
+                shutil.copyfileobj(f_r, file_obj, STAGE_COPY_SIZE)
+        file_obj.flush()
+        file_obj.seek(0)
+
     @staticmethod
     def get_full_image_content(each_name):
         """
@@ -110,6 +204,51 @@ class FullUpdateImage:
         return content
 
 
+class StagedImage:
+    """
+    An image file recorded by path and size, its data is read lazily
+    through a read-only mapping.
+    """
+
+    def __init__(self, image_path):
+        self.path = image_path
+        self.size = os.path.getsize(image_path)
+        self.digest = None
+        self.image_mmap = None
+
+    def __len__(self):
+        return self.size
+
+    def get_digest(self):
+        """
+        Get the sha256 of the image, computed once.
+        """
+        if self.digest is None:
+            hash_obj = sha256()
+            for offset in range(0, self.size, STAGE_COPY_SIZE):
+                hash_obj.update(self.read(offset, STAGE_COPY_SIZE))
+            self.digest = hash_obj.hexdigest()
+        return self.digest
+
+    def get_view(self):
+        """
+        Get a memoryview of the whole image.
+        """
+        if self.size == 0:
+            return memoryview(b'')
+        if self.image_mmap is None:
+            with open(self.path, 'rb') as f_r:
+                self.image_mmap = mmap.mmap(
+                    f_r.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.image_mmap)
+
+    def read(self, offset, length):
+        """
+        Read length bytes at offset.
+        """
+        return self.get_view()[offset:offset + length]
+
+
 class IncUpdateImage:
     """
     Increment update image class
@@ -131,71 +270,214 @@ class IncUpdateImage:
         self.offset_index = []
         self.block_size = None
         self.total_blocks = None
-        self.parse_raw_image_file(image_path, map_path)
+        self.image_mmap = None
+        self.image_view = memoryview(b'')
+        self.range_sha256_cache = OrderedDict()
+        self.open_image_mmap()
+        if OPTIONS_MANAGER.image_cache_dir:
+            image_cache = ImageCache(
+                OPTIONS_MANAGER.image_cache_dir,
+                OPTIONS_MANAGER.image_cache_size * 1024 * 1024)
+            cache_key = image_cache.get_key(image_path, map_path)
+            if not image_cache.load(self, cache_key):
+                self.parse_raw_image_file(image_path, map_path)
+                image_cache.store(self, cache_key)
+        else:
+            self.parse_raw_image_file(image_path, map_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_image_mmap(self):
+        """
+        Map the image file once, range reads are served from this mapping.
+        """
+        if os.path.getsize(self.image_path) == 0:
+            return
+        with open(self.image_path, 'rb') as f_r:
+            self.image_mmap = mmap.mmap(
+                f_r.fileno(), 0, access=mmap.ACCESS_READ)
+        self.image_view = memoryview(self.image_mmap)
+
+    def close(self):
+        """
+        Release the image mapping.
+        """
+        self.image_view.release()
+        self.image_view = memoryview(b'')
+        if self.image_mmap is not None:
+            try:
+                self.image_mmap.close()
+            except BufferError:
+                # Slices handed out by get_ranges are still alive,
+                # the mapping is released with the last of them.
+                UPDATE_LOGGER.print_log(
+                    "Image %s is still referenced, "
+                    "leave the mapping to be collected." % self.image_path)
+            self.image_mmap = None
 
     def parse_raw_image_file(self, image_path, map_path):
         """
-        Parse the .img file.
+        Parse the .img file, raw or Android sparse.
         :param image_path: img file path
         :param map_path: map file path
         """
-        self.block_size = block_size = 4096
-        self.total_blocks = total_blocks = \
-            os.path.getsize(self.image_path) // self.block_size
-        reference = b'\0' * self.block_size
-        with open(image_path, 'rb') as f_r:
-            care_value_list, offset_value_list = [], []
-            nonzero_blocks = []
-            for i in range(self.total_blocks):
-                blocks_data = f_r.read(self.block_size)
-                if blocks_data != reference:
-                    nonzero_blocks.append(i)
-                    nonzero_blocks.append(i + 1)
-            self.care_block_range = BlocksManager(nonzero_blocks)
-            care_value_list = list(self.care_block_range.range_data)
-            for idx, value in enumerate(care_value_list):
-                if idx != 0 and (idx + 1) % 2 == 0:
-                    be_value = int(care_value_list[idx - 1])
-                    af_value = int(care_value_list[idx])
-                    file_tell = be_value * block_size
-                    offset_value_list.append(
-                        (be_value, af_value - be_value,
-                         file_tell, None))
-
-            self.offset_index = [i[0] for i in offset_value_list]
-            self.offset_value_list = offset_value_list
-            extended_range = \
-                self.care_block_range.extend_value_to_blocks(EXTEND_VALUE)
-            all_blocks = BlocksManager(range_data=(0, total_blocks))
-            self.extended_range = \
-                extended_range.get_intersect_with_other(all_blocks). \
-                get_subtract_with_other(self.care_block_range)
-            self.parse_block_map_file(map_path, f_r)
-
-    def parse_block_map_file(self, map_path, image_file_r):
+        if len(self.image_view) >= struct.calcsize(SPARSE_HEADER_FORMAT) and \
+                struct.unpack_from("<I", self.image_view)[0] == \
+                SPARSE_HEADER_MAGIC:
+            offset_value_list, care_blocks = self.parse_sparse_image_file()
+            total_blocks = self.total_blocks
+        else:
+            self.block_size = block_size = 4096
+            self.total_blocks = total_blocks = \
+                os.path.getsize(self.image_path) // self.block_size
+            offset_value_list = []
+            care_blocks = scan_nonzero_blocks(
+                self.image_view, 0, total_blocks, block_size)
+            for be_value, af_value in \
+                    zip(care_blocks[0::2], care_blocks[1::2]):
+                file_tell = be_value * block_size
+                offset_value_list.append(
+                    (be_value, af_value - be_value,
+                     file_tell, None))
+        self.care_block_range = BlocksManager(care_blocks)
+        self.offset_index = [i[0] for i in offset_value_list]
+        self.offset_value_list = offset_value_list
+        extended_range = \
+            self.care_block_range.extend_value_to_blocks(EXTEND_VALUE)
+        all_blocks = BlocksManager(range_data=(0, total_blocks))
+        self.extended_range = \
+            extended_range.get_intersect_with_other(all_blocks). \
+            get_subtract_with_other(self.care_block_range)
+        self.parse_block_map_file(map_path)
+
+    def parse_sparse_image_file(self):
+        """
+        Parse the chunks of an Android sparse image. RAW chunks are read
+        from their offset in the image file, FILL and DONT_CARE chunks are
+        served from their fill data, CRC32 chunks are checked.
+        :return: offset_value_list, range data of the nonzero blocks
+        """
+        image_view = self.image_view
+        _, major_version, _, file_header_size, chunk_header_size, \
+            block_size, total_blocks, total_chunks, _ = \
+            struct.unpack_from(SPARSE_HEADER_FORMAT, image_view)
+        if major_version != 1 or block_size % 4 != 0:
+            UPDATE_LOGGER.print_log(
+                "Unsupported sparse image: %s" % self.image_path,
+                log_type=UPDATE_LOGGER.ERROR_LOG)
+            raise RuntimeError
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+
+        check_crc = SPARSE_CHUNK_TYPE_CRC32 in self.get_sparse_chunk_types(
+            file_header_size, total_chunks)
+        zero_fill = bytes(4)
+        offset_value_list = []
+        care_blocks = []
+        crc_value = 0
+        pos = file_header_size
+        block = 0
+        for _ in range(total_chunks):
+            chunk_type, _, chunk_blocks, chunk_size = struct.unpack_from(
+                SPARSE_CHUNK_HEADER_FORMAT, image_view, pos)
+            data_pos = pos + chunk_header_size
+            data_size = chunk_size - chunk_header_size
+            if chunk_type == SPARSE_CHUNK_TYPE_RAW:
+                if data_size != chunk_blocks * block_size:
+                    UPDATE_LOGGER.print_log(
+                        "Bad raw chunk size in sparse image: %s" %
+                        self.image_path, log_type=UPDATE_LOGGER.ERROR_LOG)
+                    raise RuntimeError
+                offset_value_list.append(
+                    (block, chunk_blocks, data_pos, None))
+                care_blocks.extend(block + each_block for each_block in
+                                   scan_nonzero_blocks(
+                                       image_view[data_pos:
+                                                  data_pos + data_size],
+                                       0, chunk_blocks, block_size))
+                if check_crc:
+                    crc_value = zlib.crc32(
+                        image_view[data_pos:data_pos + data_size], crc_value)
+            elif chunk_type in (SPARSE_CHUNK_TYPE_FILL,
+                                SPARSE_CHUNK_TYPE_DONT_CARE):
+                fill_data = zero_fill
+                if chunk_type == SPARSE_CHUNK_TYPE_FILL:
+                    fill_data = bytes(image_view[data_pos:data_pos + 4])
+                offset_value_list.append(
+                    (block, chunk_blocks, None, fill_data))
+                if fill_data != zero_fill:
+                    care_blocks.extend((block, block + chunk_blocks))
+                if check_crc:
+                    crc_value = self.fill_data_crc32(
+                        fill_data, chunk_blocks, crc_value)
+            elif chunk_type == SPARSE_CHUNK_TYPE_CRC32:
+                expected_crc, = struct.unpack_from("<I", image_view, data_pos)
+                if expected_crc != crc_value:
+                    UPDATE_LOGGER.print_log(
+                        "CRC32 mismatch in sparse image: %s" %
+                        self.image_path, log_type=UPDATE_LOGGER.ERROR_LOG)
+                    raise RuntimeError
+            else:
+                UPDATE_LOGGER.print_log(
+                    "Unknown chunk type 0x%x in sparse image: %s" %
+                    (chunk_type, self.image_path),
+                    log_type=UPDATE_LOGGER.ERROR_LOG)
+                raise RuntimeError
+            pos += chunk_size
+            block += chunk_blocks
+        if block != total_blocks:
+            UPDATE_LOGGER.print_log(
+                "Sparse image chunks cover %d of %d blocks: %s" %
+                (block, total_blocks, self.image_path),
+                log_type=UPDATE_LOGGER.ERROR_LOG)
+            raise RuntimeError
+        return offset_value_list, care_blocks
+
+    def get_sparse_chunk_types(self, file_header_size, total_chunks):
+        """
+        Get the chunk types of the sparse image from the chunk headers.
+        """
+        chunk_types = set()
+        pos = file_header_size
+        for _ in range(total_chunks):
+            chunk_type, _, _, chunk_size = struct.unpack_from(
+                SPARSE_CHUNK_HEADER_FORMAT, self.image_view, pos)
+            chunk_types.add(chunk_type)
+            pos += chunk_size
+        return chunk_types
+
+    def fill_data_crc32(self, fill_data, blocks, crc_value):
+        """
+        Continue crc_value over blocks filled with fill_data.
+        """
+        fill_chunk = fill_data * (ZERO_SCAN_BLOCKS * (self.block_size >> 2))
+        for start in range(0, blocks, ZERO_SCAN_BLOCKS):
+            this_blocks = min(ZERO_SCAN_BLOCKS, blocks - start)
+            crc_value = zlib.crc32(
+                memoryview(fill_chunk)[:this_blocks * self.block_size],
+                crc_value)
+        return crc_value
+
+    def parse_block_map_file(self, map_path):
         """
         Parses the map file for blocks where files are contained in the image.
         :param map_path: map file path
-        :param image_file_r: file reading object
         :return:
         """
-        remain_range = self.care_block_range
         temp_file_map = {}
 
-        with open(map_path, 'r') as f_r:
-            # Read the .map file and process each line.
-            for each_line in f_r.readlines():
-                each_map_path, ranges_value = each_line.split(None, 1)
-                each_range = BlocksManager(ranges_value)
-                each_range = each_range.get_subtract_with_other(BlocksManager("0"))
-                # each_range may not contained in the remain range.
-                intersect_range = each_range.get_intersect_with_other(remain_range)
-                if each_range.size() != intersect_range.size():
-                    each_range = intersect_range
-                temp_file_map[each_map_path] = each_range
-                # After the processing is complete,
-                # remove each_range from remain_range.
-                remain_range = remain_range.get_subtract_with_other(each_range)
+        # Read the .map file, the blocks of each line are clipped to the
+        # care blocks not taken by the earlier lines.
+        map_list = read_block_map_file(map_path)
+        clipped_list, remain_range = clip_blocks_in_order(
+            [each_range for _, each_range in map_list],
+            self.care_block_range.get_subtract_with_other(BlocksManager("0")))
+        for (each_map_path, _), each_range in zip(map_list, clipped_list):
+            temp_file_map[each_map_path] = each_range
         reserved_blocks = self.reserved_blocks
         # Remove reserved blocks from all blocks.
         remain_range = remain_range.get_subtract_with_other(reserved_blocks)
@@ -205,12 +487,11 @@ class IncUpdateImage:
         zero_blocks_list = []
         nonzero_blocks_list = []
         nonzero_groups_list = []
-        default_zero_block = ('\0' * self.block_size).encode()
 
         nonzero_blocks_list, nonzero_groups_list, zero_blocks_list = \
             self.apply_remain_range(
-                default_zero_block, image_file_r, nonzero_blocks_list,
-                nonzero_groups_list, remain_range, zero_blocks_list)
+                nonzero_blocks_list, nonzero_groups_list,
+                remain_range, zero_blocks_list)
 
         temp_file_map = self.get_file_map(
             nonzero_blocks_list, nonzero_groups_list,
@@ -219,26 +500,29 @@ class IncUpdateImage:
 
     def apply_remain_range(self, *args):
         """
-        Implement traversal processing of remain_range.
+        Implement traversal processing of remain_range. The image is not
+        read again: remain_range is cut out of care_block_range, which
+        holds the blocks found nonzero when the image was scanned, so all
+        of its blocks are nonzero and zero_blocks_list stays as it is.
+        Nonzero groups hold at most MAX_BLOCKS_PER_GROUP // 2 blocks,
+        as when blocks were added one by one.
         """
-        default_zero_block, image_file_r, \
-            nonzero_blocks_list, nonzero_groups_list, \
+        nonzero_blocks_list, nonzero_groups_list, \
             remain_range, zero_blocks_list = args
-        for start_value, end_value in remain_range:
-            for each_value in range(start_value, end_value):
-                # bisect 二分查找，b在self.offset_index中的位置
-                idx = bisect.bisect_right(self.offset_index, each_value) - 1
-                chunk_start, _, file_pos, fill_data = \
-                    self.offset_value_list[idx]
-                data = self.get_file_data(self.block_size, chunk_start,
-                                          default_zero_block, each_value,
-                                          file_pos, fill_data, image_file_r)
-
-                zero_blocks_list, nonzero_blocks_list, nonzero_groups_list = \
-                    self.get_zero_nonzero_blocks_list(
-                        data, default_zero_block, each_value,
-                        nonzero_blocks_list, nonzero_groups_list,
-                        zero_blocks_list)
+        group_limit = MAX_BLOCKS_PER_GROUP // 2
+        group_blocks = \
+            sum(nonzero_blocks_list[1::2]) - sum(nonzero_blocks_list[0::2])
+        for run_start, run_end in remain_range:
+            while run_start < run_end:
+                this_end = min(run_end,
+                               run_start + group_limit - group_blocks)
+                nonzero_blocks_list.extend((run_start, this_end))
+                group_blocks += this_end - run_start
+                run_start = this_end
+                if group_blocks >= group_limit:
+                    nonzero_groups_list.append(nonzero_blocks_list)
+                    nonzero_blocks_list = []
+                    group_blocks = 0
         return nonzero_blocks_list, nonzero_groups_list, zero_blocks_list
 
     @staticmethod
@@ -267,79 +551,39 @@ class IncUpdateImage:
             temp_file_map[FILE_MAP_COPY_KEY] = reserved_blocks
         return temp_file_map
 
-    @staticmethod
-    def get_zero_nonzero_blocks_list(*args):
-        """
-        Get zero_blocks_list, nonzero_blocks_list, and nonzero_groups_list.
-        data: block data,
-        default_zero_block: default to zero block,
-        each_value: each value,
-        nonzero_blocks_list: nonzero_blocks_list,
-        nonzero_groups_list: nonzero_groups_list,
-        zero_blocks_list: zero_blocks_list,
-        :return new_zero_blocks_list: new zero blocks list,
-        :return new_nonzero_blocks_list: new nonzero blocks list,
-        :return new_nonzero_groups_list: new nonzero groups list.
-        """
-        data, default_zero_block, each_value, \
-            nonzero_blocks_list, nonzero_groups_list, \
-            zero_blocks_list = args
-        # Check whether the data block is equal to the default zero_blocks.
-        if data == default_zero_block:
-            zero_blocks_list.append(each_value)
-            zero_blocks_list.append(each_value + 1)
-        else:
-            nonzero_blocks_list.append(each_value)
-            nonzero_blocks_list.append(each_value + 1)
-            # The number of nonzero_blocks is greater than
-            # or equal to the upper limit.
-            if len(nonzero_blocks_list) >= MAX_BLOCKS_PER_GROUP:
-                nonzero_groups_list.append(nonzero_blocks_list)
-                nonzero_blocks_list = []
-        new_zero_blocks_list, new_nonzero_blocks_list, \
-            new_nonzero_groups_list = \
-            copy.copy(zero_blocks_list), \
-            copy.copy(nonzero_blocks_list),\
-            copy.copy(nonzero_groups_list)
-        return new_zero_blocks_list, new_nonzero_blocks_list, \
-            new_nonzero_groups_list
-
-    @staticmethod
-    def get_file_data(*args):
-        """
-        Get the file data.
-        block_size: blocksize,
-        chunk_start: the start position of chunk,
-        default_zero_block: default to zero blocks,
-        each_value: each_value,
-        file_pos: file position,
-        fill_data: data,
-        image_file_r: read file object,
-        :return data: Get the file data.
-        """
-        block_size, chunk_start, default_zero_block, each_value, \
-            file_pos, fill_data, image_file_r = args
-        if file_pos is not None:
-            file_pos += (each_value - chunk_start) * block_size
-            image_file_r.seek(file_pos, os.SEEK_SET)
-            data = image_file_r.read(block_size)
-        else:
-            if fill_data == default_zero_block[:4]:
-                data = default_zero_block
-            else:
-                data = None
-        return data
-
     def range_sha256(self, ranges):
         """
         range sha256 hash content
         :param ranges: ranges value
         :return:
         """
-        hash_obj = sha256()
-        for data in self.__get_blocks_set_data(ranges):
-            hash_obj.update(data)
-        return hash_obj.hexdigest()
+        return self.range_sha256_list([ranges])[0]
+
+    def range_sha256_list(self, ranges_list):
+        """
+        Get the sha256 of many ranges, ranges not in the cache are hashed
+        in one pass ordered by their first block. BlocksManager instances
+        are interned, so the cache is keyed by the ranges themselves.
+        :param ranges_list: list of ranges values
+        :return: list of sha256 hex digests
+        """
+        cache = self.range_sha256_cache
+        digests = {}
+        for ranges in ranges_list:
+            if ranges in cache:
+                cache.move_to_end(ranges)
+                digests[ranges] = cache[ranges]
+        missing = sorted(
+            (ranges for ranges in set(ranges_list) if ranges not in digests),
+            key=lambda ranges: ranges.range_view()[:1].tolist())
+        for ranges in missing:
+            hash_obj = sha256()
+            for data in self.__get_blocks_set_data(ranges):
+                hash_obj.update(data)
+            digests[ranges] = cache[ranges] = hash_obj.hexdigest()
+            if len(cache) > RANGE_SHA256_CACHE_SIZE:
+                cache.popitem(last=False)
+        return [digests[ranges] for ranges in ranges_list]
 
     def write_range_data_2_fd(self, ranges, file_obj):
         """
@@ -351,6 +595,17 @@ class IncUpdateImage:
         for data in self.__get_blocks_set_data(ranges):
             file_obj.write(data)
 
+    def get_block_data(self, block):
+        """
+        Get the data of one block from the chunk holding it.
+        :param block: block number
+        :return: block data, None if the block is not in care_block_range
+        """
+        if block < 0 or bisect.bisect_right(
+                self.care_block_range.range_view(), block) % 2 == 0:
+            return None
+        return next(self.__get_blocks_set_data(((block, block + 1),)))
+
     def get_ranges(self, ranges):
         """
         get ranges value
@@ -361,33 +616,32 @@ class IncUpdateImage:
 
     def __get_blocks_set_data(self, blocks_set_data):
         """
-        Get the range data.
+        Get the range data as memoryview slices of the image mapping.
         """
-        with open(self.image_path, 'rb') as f_r:
-            for start, end in blocks_set_data:
-                diff_value = end - start
-                idx = bisect.bisect_right(self.offset_index, start) - 1
+        image_view = self.image_view
+        for start, end in blocks_set_data:
+            diff_value = end - start
+            idx = bisect.bisect_right(self.offset_index, start) - 1
+            chunk_start, chunk_len, file_pos, fill_data = \
+                self.offset_value_list[idx]
+
+            remain = chunk_len - (start - chunk_start)
+            this_read = min(remain, diff_value)
+            if file_pos is not None:
+                pos = file_pos + ((start - chunk_start) * self.block_size)
+                yield image_view[pos:pos + this_read * self.block_size]
+            else:
+                yield fill_data * (this_read * (self.block_size >> 2))
+            diff_value -= this_read
+
+            while diff_value > 0:
+                idx += 1
                 chunk_start, chunk_len, file_pos, fill_data = \
                     self.offset_value_list[idx]
-
-                remain = chunk_len - (start - chunk_start)
-                this_read = min(remain, diff_value)
+                this_read = min(chunk_len, diff_value)
                 if file_pos is not None:
-                    pos = file_pos + ((start - chunk_start) * self.block_size)
-                    f_r.seek(pos, os.SEEK_SET)
-                    yield f_r.read(this_read * self.block_size)
+                    yield image_view[
+                        file_pos:file_pos + this_read * self.block_size]
                 else:
                     yield fill_data * (this_read * (self.block_size >> 2))
                 diff_value -= this_read
-
-                while diff_value > 0:
-                    idx += 1
-                    chunk_start, chunk_len, file_pos, fill_data = \
-                        self.offset_value_list[idx]
-                    this_read = min(chunk_len, diff_value)
-                    if file_pos is not None:
-                        f_r.seek(file_pos, os.SEEK_SET)
-                        yield f_r.read(this_read * self.block_size)
-                    else:
-                        yield fill_data * (this_read * (self.block_size >> 2))
-                    diff_value -= this_read
\ No newline at end of file
@@ -23,6 +23,7 @@ import tempfile
 from utils import OPTIONS_MANAGER
 from utils import DIFF_EXE_PATH
 from transfers_manager import ActionType
+from transfer_list import DiffCommand
 
 DIFF_BLOCK_LIMIT = 10240
 
@@ -74,16 +75,14 @@ class PatchPackageChunk:
             if temp_blocks < 0:
                 temp_blocks = 0
             else:
-                temp_src_blocks_to_write = src_file_blocks.get_first_block_obj(temp_blocks)
-                src_file_blocks = src_file_blocks.get_subtract_with_other(temp_src_blocks_to_write)
+                _, src_file_blocks = src_file_blocks.split_first_block_obj(temp_blocks)
             src_blocks_to_write = src_file_blocks.get_first_block_obj(blocks)
             src_start = src_file_bytes - blocks * build_module_img.BLOCK_SIZE
             if src_start < 0:
                 src_start = 0
         else:
             src_start = start_blocks * build_module_img.BLOCK_SIZE
-            src_blocks_to_write = src_file_blocks.get_first_block_obj(blocks)
-            src_file_blocks = src_file_blocks.get_subtract_with_other(src_blocks_to_write)
+            src_blocks_to_write, src_file_blocks = src_file_blocks.split_first_block_obj(blocks)
 
         if src_file_bytes == 0:
             print(f'error: {src_file_bytes}')
@@ -108,8 +107,7 @@ class PatchPackageChunk:
     
     def split_new_tgt_file(self, each_action, start_blocks, blocks, tgt_file_blocks, tgt_file_obj):
         """处理新目标文件的分块逻辑"""
-        tgt_blocks_to_write = tgt_file_blocks.get_first_block_obj(blocks)
-        tgt_file_blocks = tgt_file_blocks.get_subtract_with_other(tgt_blocks_to_write)
+        tgt_blocks_to_write, tgt_file_blocks = tgt_file_blocks.split_first_block_obj(blocks)
         tgt_file_obj.seek(int(start_blocks * build_module_img.BLOCK_SIZE))
         self.chunk_tgt_obj.seek(0)
         self.chunk_tgt_obj.truncate(0)
@@ -141,17 +139,19 @@ class PatchPackageChunk:
         # 如果 patch 有内容，保存到 transfer_content 和其他相关变量
         if len(patch_value) > 0:
             diff_type = "pkgdiff" if self.do_pkg_diff else "bsdiff"
-            diff_str = ("%s %d %d %s %s %s %d %s\n" % (
+            diff_command = DiffCommand(
                 diff_type,
                 self.diff_offset, len(patch_value),
                 self.src_img_obj.range_sha256(src_blocks_to_write),
                 self.tgt_img_obj.range_sha256(tgt_blocks_to_write),
-                tgt_blocks_to_write.to_string_raw(), src_blocks_to_write.size(), src_blocks_to_write.to_string_raw()))
-            print(diff_str)
+                tgt_blocks_to_write, "%d %s" % (
+                    src_blocks_to_write.size(),
+                    src_blocks_to_write.to_string_raw()))
+            print(diff_command.to_string())
 
             self.diff_offset += len(patch_value)
             self.chunk_data_list.append(patch_value)
-            self.transfer_content.append(diff_str)
+            self.transfer_content.append(diff_command)
 
             # 打印 transfer_content 长度信息
             print(f'in transfer_content len: {len(self.transfer_content)} '
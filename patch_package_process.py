@@ -18,9 +18,12 @@ import multiprocessing
 import subprocess
 import tempfile
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import pointer
 from log_exception import UPDATE_LOGGER
 from blocks_manager import BlocksManager
+from blocks_manager import BlocksAccumulator
 from transfers_manager import ActionType
 from update_package import PkgHeader
 from update_package import PkgComponent
@@ -29,10 +32,21 @@ from utils import ON_SERVER
 from utils import DIFF_EXE_PATH
 from patch_package_chunk import PatchPackageChunk
 from create_chunk import get_chunk_sha256
+from transfer_list import DiffCommand
+from transfer_list import EraseCommand
+from transfer_list import FreeCommand
+from transfer_list import MoveCommand
+from transfer_list import NewCommand
+from transfer_list import StashCommand
+from transfer_list import ZeroCommand
+from transfer_list import get_transfer_list_text
+from transfer_list import write_transfer_list
 
 NEW_DAT = "new.dat"
 PATCH_DAT = "patch.dat"
 TRANSFER_LIST = "transfer.list"
+# Targets larger than this many blocks (500M) are written as NEW.
+MAX_DIFF_BLOCKS = 125 * 1024
 
 
 class PatchProcess:
@@ -44,40 +58,40 @@ class PatchProcess:
         self.tgt_img_obj = tgt_image
         self.src_img_obj = src_image
         self.version = 1
-        self.touched_src_ranges = BlocksManager()
+        self.touched_src_accumulator = BlocksAccumulator()
         self.touched_src_sha256 = None
         self.package_patch_zip = PackagePatchZip(partition)
         # ab copy param
         self.chunk_data_list = []
         self.chunk_new_list = []
         self.transfer_content_in_chunk = []
+        # patches computed ahead by the worker threads
+        self.diff_executor = None
+        self.diff_candidates = iter(())
+        self.diff_jobs = OrderedDict()
+
+    @property
+    def touched_src_ranges(self):
+        """
+        Source blocks read by the transfer commands so far.
+        """
+        return self.touched_src_accumulator.get_blocks()
     
-    @staticmethod
-    def get_transfer_content(max_stashed_blocks, total_blocks_count,
+    def get_transfer_content(self, max_stashed_blocks, total_blocks_count,
                              transfer_content):
         """
         Get the tranfer content.
+        :param transfer_content: transfer command list
         """
-        transfer_content = ''.join(transfer_content)
-        transfer_content = \
-            transfer_content.replace("TOTAL_MARK", str(total_blocks_count))
-        transfer_content = \
-            transfer_content.replace("MAX_STASH_MARK", str(max_stashed_blocks))
-        transfer_content = \
-            transfer_content.replace("ActionType.MOVE", "move")
-        transfer_content = \
-            transfer_content.replace("ActionType.ZERO", "zero")
-        transfer_content = \
-            transfer_content.replace("ActionType.NEW", "new")
-        return transfer_content
+        return get_transfer_list_text(self.version, total_blocks_count,
+                                      max_stashed_blocks, transfer_content)
     
     @staticmethod
     def check_partition(total, seq):
-        so_far = BlocksManager()
-        for i in seq:
-            if so_far.is_overlaps(i):
-                raise RuntimeError
-            so_far = so_far.get_union_with_other(i)
+        so_far = BlocksManager.union_all(seq)
+        # Overlapping parts would make the union smaller than the sum.
+        if so_far.size() != sum(i.size() for i in seq):
+            raise RuntimeError
         if so_far != total:
             raise RuntimeError
 
@@ -85,7 +99,7 @@ class PatchProcess:
     def write_split_transfers(self, transfer_content, type_str, target_blocks, each_img_file):
         """
         Limit the size of operand in command 'new' and 'zero' to 1024 blocks.
-        :param transfer_content: transfer content list
+        :param transfer_content: transfer command list
         :param type_str: type of the action to be processed.
         :param target_blocks: BlocksManager of the target blocks
         :return: total
@@ -97,8 +111,7 @@ class PatchProcess:
         else:
             blocks_limit = 1024
         total = 0
-        while target_blocks.size() != 0:
-            blocks_to_write = target_blocks.get_first_block_obj(blocks_limit)
+        for blocks_to_write in target_blocks.split_by_block_count(blocks_limit):
             # Find the corresponding new.dat from the set of blocks
             new_data = b''
             if type_str == ActionType.NEW:
@@ -109,14 +122,12 @@ class PatchProcess:
             # 为流式升级new添加hash值
             if OPTIONS_MANAGER.stream_update and type_str == ActionType.NEW:
                 transfer_content.append(
-                    "%s %s %s\n" % (type_str, get_chunk_sha256(new_data),
-                                    blocks_to_write.to_string_raw()))
+                    NewCommand(blocks_to_write, get_chunk_sha256(new_data)))
+            elif type_str == ActionType.NEW:
+                transfer_content.append(NewCommand(blocks_to_write))
             else:
-                transfer_content.append(
-                    "%s %s\n" % (type_str, blocks_to_write.to_string_raw()))
+                transfer_content.append(ZeroCommand(blocks_to_write))
             total += blocks_to_write.size()
-            target_blocks = \
-                target_blocks.get_subtract_with_other(blocks_to_write)       
         return total
     
     @staticmethod
@@ -127,9 +138,7 @@ class PatchProcess:
         :param each_img_file: The image file to read from.
         :return: new_data
         """
-         # 解析写入的块
-        parse_range = self.parse_ranges(blocks_to_write.to_string_raw())
-        for start, end in parse_range:
+        for start, end in blocks_to_write:
             start_index = start * 4096
             end_index = end * 4096
             print(f'start_index: {start}, end_index: {end}')
@@ -185,11 +194,63 @@ class PatchProcess:
         total_blocks_count = 0
         stashed_blocks = 0
         max_stashed_blocks = 0
-        transfer_content = ["%d\n" % self.version, "TOTAL_MARK\n",
-                            "0\n", "MAX_STASH_MARK\n"]
+        transfer_content = []
 
         diff_offset = 0
+        # The patches are only computed ahead when splitting was asked
+        # for with -spb, so the default build stays single-threaded.
+        if OPTIONS_MANAGER.split_piece_blocks > 0 and \
+                self.worker_threads > 1:
+            self.diff_executor = ThreadPoolExecutor(
+                max_workers=self.worker_threads)
+            self.diff_candidates = self.iter_diff_candidates()
+        try:
+            diff_offset, max_stashed_blocks, total_blocks_count = \
+                self.process_actions(
+                    diff_offset, each_img_file, max_stashed_blocks,
+                    new_dat_file_obj, patch_dat_file_obj, stashed_blocks,
+                    stashes, total_blocks_count, transfer_content)
+        finally:
+            if self.diff_executor is not None:
+                self.diff_executor.shutdown()
+                self.diff_executor = None
+
+        self.after_for_process(max_stashed_blocks, total_blocks_count,
+                               transfer_content, transfer_list_file_obj, each_img_file)
+
+    def iter_diff_candidates(self):
+        """
+        Yield the DIFFERENT actions apply_diff_style computes a patch for,
+        in the order they are processed.
+        """
         for each_action in self.actions_list:
+            if each_action.type_str == ActionType.DIFFERENT and \
+                    each_action.tgt_block_set.size() <= MAX_DIFF_BLOCKS and \
+                    self.tgt_img_obj.range_sha256(each_action.tgt_block_set) != \
+                    self.src_img_obj.range_sha256(each_action.src_block_set):
+                yield each_action
+
+    def schedule_diff_patches(self):
+        """
+        Keep the worker threads busy with the patches of the next actions.
+        """
+        while self.diff_executor is not None and \
+                len(self.diff_jobs) < self.worker_threads * 2:
+            each_action = next(self.diff_candidates, None)
+            if each_action is None:
+                break
+            self.diff_jobs[each_action] = self.diff_executor.submit(
+                self.get_diff_patch, each_action)
+
+    def process_actions(self, *args):
+        """
+        Add the transfer commands of every action.
+        """
+        diff_offset, each_img_file, max_stashed_blocks, new_dat_file_obj, \
+            patch_dat_file_obj, stashed_blocks, stashes, total_blocks_count, \
+            transfer_content = args
+        for each_action in self.actions_list:
+            self.schedule_diff_patches()
             max_stashed_blocks, stashed_blocks = self.add_stash_command(
                 each_action, max_stashed_blocks, stashed_blocks, stashes,
                 transfer_content)
@@ -220,12 +281,10 @@ class PatchProcess:
                                         each_action.type_str)
                 raise RuntimeError
             if free_commands_list:
-                transfer_content.append("".join(free_commands_list))
+                transfer_content.extend(free_commands_list)
                 stashed_blocks -= free_size
+        return diff_offset, max_stashed_blocks, total_blocks_count
 
-        self.after_for_process(max_stashed_blocks, total_blocks_count,
-                               transfer_content, transfer_list_file_obj, each_img_file)
-        
     def apply_new_type(self, each_action, new_dat_file_obj, tgt_size,
                        total_blocks_count, transfer_content, each_img_file):
         self.tgt_img_obj.write_range_data_2_fd(
@@ -242,7 +301,7 @@ class PatchProcess:
         return total_blocks_count
 
     def apply_zero_type(self, each_action, total_blocks_count,
-                        transfer_content, each_img_file):
+                        transfer_content, each_img_file=None):
         UPDATE_LOGGER.print_log("%7s %s %s" % (
             each_action.type_str, each_action.tgt_name,
             str(each_action.tgt_block_set)))
@@ -278,7 +337,7 @@ class PatchProcess:
                     each_action, max_stashed_blocks, src_str,
                     stashed_blocks, tgt_size, total_blocks_count,
                     transfer_content)
-        elif each_action.tgt_block_set.size() > 125 * 1024: # target_file_size > 125 * 1024 * 4KB = 500M
+        elif each_action.tgt_block_set.size() > MAX_DIFF_BLOCKS:
             each_action.type_str = ActionType.NEW
             new_dat_file_obj, patch_dat_file_obj, transfer_list_file_obj = \
                 self.package_patch_zip.get_file_obj()
@@ -324,7 +383,7 @@ class PatchProcess:
         Implement processing after cyclical actions_list processing.
         :param max_stashed_blocks: maximum number of stashed blocks in actions
         :param total_blocks_count: total number of blocks
-        :param transfer_content: transfer content
+        :param transfer_content: transfer command list
         :param transfer_list_file_obj: transfer file object
         :return:
         """
@@ -344,15 +403,15 @@ class PatchProcess:
         new_not_care = all_tgt_minus_extended.get_subtract_with_other(
             self.tgt_img_obj.care_block_range)
         self.add_erase_content(new_not_care, transfer_content)
-        transfer_content = self.get_transfer_content(
-            max_stashed_blocks, total_blocks_count, transfer_content)
-        # Print the transfer_content before writing it to the file
         if OPTIONS_MANAGER.stream_update:
             # 暂时先不写入transfer_list 等到copy命令处理完，再统一写入
-            self.transfer_content_in_chunk = transfer_content
+            self.transfer_content_in_chunk = self.get_transfer_content(
+                max_stashed_blocks, total_blocks_count, transfer_content)
             OPTIONS_MANAGER.max_stash_size = max(max_stashed_blocks * 4096, OPTIONS_MANAGER.max_stash_size)
         else: 
-            transfer_list_file_obj.write(transfer_content.encode())
+            write_transfer_list(transfer_list_file_obj, self.version,
+                                total_blocks_count, max_stashed_blocks,
+                                transfer_content)
             OPTIONS_MANAGER.max_stash_size = max(max_stashed_blocks * 4096, OPTIONS_MANAGER.max_stash_size)
         
     def add_diff_command(self, *args):
@@ -361,43 +420,31 @@ class PatchProcess:
         """
         diff_offset, do_pkg_diff, each_action,\
             patch_value, src_str, transfer_content = args
-        self.touched_src_ranges = self.touched_src_ranges.get_union_with_other(
-            each_action.src_block_set)
+        self.touched_src_accumulator.add(each_action.src_block_set)
         diff_type = "pkgdiff" if do_pkg_diff else "bsdiff"
-        transfer_content.append("%s %d %d %s %s %s %s\n" % (
+        transfer_content.append(DiffCommand(
             diff_type,
             diff_offset, len(patch_value),
             self.src_img_obj.range_sha256(each_action.src_block_set),
             self.tgt_img_obj.range_sha256(each_action.tgt_block_set),
-            each_action.tgt_block_set.to_string_raw(), src_str))
+            each_action.tgt_block_set, src_str))
 
     def compute_diff_patch(self, each_action, patch_dat_file_obj, diff_offset,
                            src_str, transfer_content, chunk_data_list, tgt_size, total_blocks_count, each_img_file):
         """
         Run the command to calculate the differential patch.
         """
-        src_file_obj = \
-            tempfile.NamedTemporaryFile(prefix="src-", mode='wb')
-        self.src_img_obj.write_range_data_2_fd(
-            each_action.src_block_set, src_file_obj)
-        src_file_obj.seek(0)
-        tgt_file_obj = tempfile.NamedTemporaryFile(
-            prefix="tgt-", mode='wb')
-        self.tgt_img_obj.write_range_data_2_fd(
-            each_action.tgt_block_set, tgt_file_obj)
-        tgt_file_obj.seek(0)
-        OPTIONS_MANAGER.incremental_temp_file_obj_list.append(
-            src_file_obj)
-        OPTIONS_MANAGER.incremental_temp_file_obj_list.append(
-            tgt_file_obj)
-        do_pkg_diff = True
         try:
-            patch_value, do_pkg_diff = self.apply_compute_patch(
-                src_file_obj.name, tgt_file_obj.name, 4096, do_pkg_diff)
+            diff_job = self.diff_jobs.pop(each_action, None)
+            if diff_job is not None:
+                src_file_obj, tgt_file_obj, patch_value, do_pkg_diff = \
+                    diff_job.result()
+            else:
+                src_file_obj, tgt_file_obj, patch_value, do_pkg_diff = \
+                    self.get_diff_patch(each_action)
             # If the patch is larger than 45kb
             if OPTIONS_MANAGER.stream_update and len(patch_value) > OPTIONS_MANAGER.chunk_limit * 4096:
-                self.touched_src_ranges = self.touched_src_ranges.get_union_with_other(
-                    each_action.src_block_set)  
+                self.touched_src_accumulator.add(each_action.src_block_set)  
                 if each_action.tgt_block_set.size() % 10 == 1 or each_action.src_block_set.size() <= 1:
                     each_action.type_str = ActionType.NEW
                     new_dat_file_obj, patch_dat_file_obj, transfer_list_file_obj = \
@@ -429,6 +476,30 @@ class PatchProcess:
             
         return do_pkg_diff, patch_value, diff_offset
     
+    def get_diff_patch(self, each_action):
+        """
+        Write the src and tgt blocks of the action to temporary files and
+        compute the patch between them, run by the worker threads.
+        :return: src_file_obj, tgt_file_obj, patch_value, do_pkg_diff
+        """
+        src_file_obj = \
+            tempfile.NamedTemporaryFile(prefix="src-", mode='wb')
+        self.src_img_obj.write_range_data_2_fd(
+            each_action.src_block_set, src_file_obj)
+        src_file_obj.seek(0)
+        tgt_file_obj = tempfile.NamedTemporaryFile(
+            prefix="tgt-", mode='wb')
+        self.tgt_img_obj.write_range_data_2_fd(
+            each_action.tgt_block_set, tgt_file_obj)
+        tgt_file_obj.seek(0)
+        OPTIONS_MANAGER.incremental_temp_file_obj_list.append(
+            src_file_obj)
+        OPTIONS_MANAGER.incremental_temp_file_obj_list.append(
+            tgt_file_obj)
+        patch_value, do_pkg_diff = self.apply_compute_patch(
+            src_file_obj.name, tgt_file_obj.name, 4096, True)
+        return src_file_obj, tgt_file_obj, patch_value, do_pkg_diff
+
     def add_move_command(self, *args):
         """
         Add the move command.
@@ -445,16 +516,11 @@ class PatchProcess:
                 if stashed_blocks > max_stashed_blocks:
                     max_stashed_blocks = stashed_blocks
 
-            self.touched_src_ranges = \
-                self.touched_src_ranges.get_union_with_other(src_block_set)
+            self.touched_src_accumulator.add(src_block_set)
 
-            transfer_content.append(
-                "{type_str} {tgt_hash} {tgt_string} {src_str}\n".
-                format(type_str=each_action.type_str,
-                       tgt_hash=self.tgt_img_obj.
-                       range_sha256(each_action.tgt_block_set),
-                       tgt_string=tgt_block_set.to_string_raw(),
-                       src_str=src_str))
+            transfer_content.append(MoveCommand(
+                self.tgt_img_obj.range_sha256(each_action.tgt_block_set),
+                tgt_block_set, src_str))
             total_blocks_count += tgt_size
         return max_stashed_blocks, stashed_blocks, total_blocks_count
 
@@ -486,7 +552,7 @@ class PatchProcess:
                 "%s:%s" % (src_range_sha, each_stash_before.to_string_raw()))
             stashes[src_range_sha] -= 1
             if stashes[src_range_sha] == 0:
-                free_commands_list.append("free %s\n" % (src_range_sha,))
+                free_commands_list.append(FreeCommand(src_range_sha))
                 free_size += each_stash_before.size()
                 stashes.pop(src_range_sha)
         self.apply_stashed_range(each_action, mapped_stashes, src_blocks_size,
@@ -519,22 +585,22 @@ class PatchProcess:
         :param max_stashed_blocks: number of max stash blocks in all actions
         :param stashed_blocks: number of stash blocks
         :param stashes: Stash dict
-        :param transfer_content: transfer content list
+        :param transfer_content: transfer command list
         :return: max_stashed_blocks, stashed_blocks
         """
-        for _, each_stash_before in each_action.stash_before:
-            src_range_sha = \
-                self.src_img_obj.range_sha256(each_stash_before)
+        stash_before_list = [each_stash_before for _, each_stash_before
+                             in each_action.stash_before]
+        for each_stash_before, src_range_sha in zip(
+                stash_before_list,
+                self.src_img_obj.range_sha256_list(stash_before_list)):
             if src_range_sha in stashes:
                 stashes[src_range_sha] += 1
             else:
                 stashes[src_range_sha] = 1
                 stashed_blocks += each_stash_before.size()
-                self.touched_src_ranges = \
-                    self.touched_src_ranges.\
-                    get_union_with_other(each_stash_before)
-                transfer_content.append("stash %s %s\n" % (
-                    src_range_sha, each_stash_before.to_string_raw()))
+                self.touched_src_accumulator.add(each_stash_before)
+                transfer_content.append(
+                    StashCommand(src_range_sha, each_stash_before))
         if stashed_blocks > max_stashed_blocks:
             max_stashed_blocks = stashed_blocks
         return max_stashed_blocks, stashed_blocks
@@ -577,18 +643,16 @@ class PatchProcess:
         """
         Add the erase command.
         :param new_not_care: blocks that don't need to be cared about
-        :param transfer_content: transfer content list
+        :param transfer_content: transfer command list
         :return:
         """
         erase_first = new_not_care.\
             get_subtract_with_other(self.touched_src_ranges)
         if erase_first.size() != 0:
-            transfer_content.insert(
-                4, "erase %s\n" % (erase_first.to_string_raw(),))
+            transfer_content.insert(0, EraseCommand(erase_first))
         erase_last = new_not_care.get_subtract_with_other(erase_first)
         if erase_last.size() != 0:
-            transfer_content.append(
-                "erase %s\n" % (erase_last.to_string_raw(),))
+            transfer_content.append(EraseCommand(erase_last))
 
     def add_ab_copy_content(self, blocks_length, need_copy_blocks_list, transfer_content):
         """
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Description : benchmark the BlocksManager set algebra.
+Usage: python3 -m test.benchmark_blocks_manager [--sizes 10000,100000]
+"""
+import argparse
+import operator
+import random
+import time
+
+from blocks_manager import BlocksManager
+
+DEFAULT_SIZES = "10000,100000,1000000"
+# The nested-loop engine is O(n*m), skip it above this many range pairs.
+DEFAULT_LEGACY_LIMIT = 2000
+
+
+class LegacyBlocksEngine:
+    """
+    The pairwise set algebra BlocksManager used before the merge sweep.
+    """
+
+    @staticmethod
+    def intersect(range_a, range_b):
+        other_data, data, new_data = list(range_a), list(range_b), []
+        for i in range(len(data) // 2):
+            for j in range(len(other_data) // 2):
+                data_list1 = [data[i * 2], data[i * 2 + 1], other_data[j * 2],
+                              other_data[j * 2 + 1]]
+                data_list2 = [other_data[j * 2], other_data[j * 2 + 1],
+                              data[i * 2], data[i * 2 + 1]]
+                sort_list = sorted(data_list1)
+                if operator.ne(sort_list, data_list1) and \
+                        operator.ne(sort_list, data_list2):
+                    new_data.append(sort_list[1])
+                    new_data.append(sort_list[2])
+        return BlocksManager(range_data=new_data).range_data
+
+    @classmethod
+    def subtract(cls, range_a, range_b):
+        new_data = list(range_a) + list(cls.intersect(range_a, range_b))
+        new_data.sort()
+        return BlocksManager(range_data=new_data).range_data
+
+    @classmethod
+    def union(cls, range_a, range_b):
+        new_data = list(cls.subtract(range_a, range_b))
+        new_data.extend(cls.subtract(range_b, range_a))
+        new_data.extend(cls.intersect(range_a, range_b))
+        new_data.sort()
+        return BlocksManager(range_data=new_data).range_data
+
+
+def random_range_data(pairs, seed):
+    """
+    Create sorted, non-adjacent range data with the given number of pairs.
+    """
+    rand = random.Random(seed)
+    data = []
+    value = 0
+    for _ in range(pairs):
+        value += rand.randint(1, 8)
+        data.append(value)
+        value += rand.randint(1, 8)
+        data.append(value)
+    return data
+
+
+def timed(func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start_time, result
+
+
+def run_benchmark(sizes, legacy_limit):
+    print("%10s %10s %12s %12s" % ("pairs", "operation", "sweep(s)", "legacy(s)"))
+    for pairs in sizes:
+        data_a = random_range_data(pairs, 1)
+        data_b = random_range_data(pairs, 2)
+        range_a, range_b = BlocksManager(data_a), BlocksManager(data_b)
+        operations = (
+            ("intersect", range_a.get_intersect_with_other,
+             LegacyBlocksEngine.intersect),
+            ("subtract", range_a.get_subtract_with_other,
+             LegacyBlocksEngine.subtract),
+            ("union", range_a.get_union_with_other,
+             LegacyBlocksEngine.union),
+            ("overlaps", range_a.is_overlaps, None),
+        )
+        for name, sweep_func, legacy_func in operations:
+            sweep_time, sweep_result = timed(sweep_func, range_b)
+            legacy_str = "skipped"
+            if legacy_func is not None and pairs <= legacy_limit:
+                legacy_time, legacy_result = timed(
+                    legacy_func, range_a.range_data, range_b.range_data)
+                if legacy_result != sweep_result.range_data:
+                    raise RuntimeError("%s result mismatch" % name)
+                legacy_str = "%.4f" % legacy_time
+            print("%10d %10s %12.4f %12s" % (pairs, name, sweep_time, legacy_str))
+        extend_time, _ = timed(range_a.extend_value_to_blocks, 512)
+        print("%10d %10s %12.4f %12s" % (pairs, "extend", extend_time, "skipped"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="comma separated numbers of range pairs")
+    parser.add_argument("--legacy-limit", type=int,
+                        default=DEFAULT_LEGACY_LIMIT,
+                        help="largest size the legacy engine is run on")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    run_benchmark(sizes, args.legacy_limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Description : measure the memory used by the file maps of a large image,
+and the time of the zero block scan with and without NumPy.
+Usage: python3 -m test.benchmark_image_memory [--blocks 262144] [--no-numpy]
+"""
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import image_class
+from image_class import IncUpdateImage
+from image_class import scan_nonzero_blocks
+
+BLOCK_SIZE = 4096
+DEFAULT_BLOCKS = 256 * 1024
+DEFAULT_FILES = 20000
+
+
+def create_image_and_map(work_dir, total_blocks, file_count):
+    """
+    Create a sparse raw image whose files are scattered in small extents,
+    and the matching .map file.
+    """
+    rand = random.Random(0)
+    image_path = os.path.join(work_dir, "bench.img")
+    map_path = os.path.join(work_dir, "bench.map")
+    file_blocks = {}
+    block = 1
+    file_idx = 0
+    while block < total_blocks - 8:
+        extent = rand.randint(1, 4)
+        file_blocks.setdefault(file_idx % file_count, []).append(
+            (block, block + extent))
+        block += extent + rand.randint(0, 2)
+        file_idx += 1
+    with open(image_path, 'wb') as w_f:
+        w_f.truncate(total_blocks * BLOCK_SIZE)
+        for extents in file_blocks.values():
+            for start_value, end_value in extents:
+                w_f.seek(start_value * BLOCK_SIZE)
+                w_f.write(b'\1' * (end_value - start_value) * BLOCK_SIZE)
+    with open(map_path, 'w') as w_f:
+        for idx, extents in file_blocks.items():
+            w_f.write("/system/file%d %s\n" % (idx, " ".join(
+                "%d-%d" % (start_value, end_value - 1)
+                for start_value, end_value in extents)))
+    return image_path, map_path
+
+
+def time_zero_scan(image_path, use_numpy):
+    """
+    Time one scan_nonzero_blocks pass over the whole image.
+    """
+    numpy_module = image_class.numpy
+    if not use_numpy:
+        image_class.numpy = None
+    try:
+        with open(image_path, 'rb') as f_r:
+            data = f_r.read()
+        start_time = time.perf_counter()
+        scan_nonzero_blocks(memoryview(data), 0, len(data) // BLOCK_SIZE,
+                            BLOCK_SIZE)
+        return time.perf_counter() - start_time
+    finally:
+        image_class.numpy = numpy_module
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=DEFAULT_BLOCKS,
+                        help="number of 4 KiB blocks in the image")
+    parser.add_argument("--files", type=int, default=DEFAULT_FILES,
+                        help="number of files in the .map file")
+    parser.add_argument("--no-numpy", action="store_true",
+                        help="build the image without NumPy")
+    args = parser.parse_args()
+
+    numpy_module = image_class.numpy
+    with tempfile.TemporaryDirectory(prefix="bench-") as work_dir:
+        image_path, map_path = create_image_and_map(
+            work_dir, args.blocks, args.files)
+        scan_times = [("no numpy", time_zero_scan(image_path, False))]
+        if numpy_module is not None:
+            scan_times.append(("numpy", time_zero_scan(image_path, True)))
+        if args.no_numpy:
+            image_class.numpy = None
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        image = IncUpdateImage(image_path, map_path)
+        elapsed = time.perf_counter() - start_time
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        image.close()
+        image_class.numpy = numpy_module
+
+    range_pairs = sum(len(blocks.range_view()) // 2
+                      for blocks in image.file_map.values())
+    print("blocks: %d, file map entries: %d, range pairs: %d" %
+          (args.blocks, len(image.file_map), range_pairs))
+    print("build time: %.2fs%s" % (
+        elapsed, " (no numpy)" if args.no_numpy or numpy_module is None
+        else ""))
+    for name, scan_time in scan_times:
+        print("zero scan time, %s: %.2fs" % (name, scan_time))
+    print("traced memory: current %.1f MiB, peak %.1f MiB" %
+          (current / 1024 / 1024, peak / 1024 / 1024))
+    print("max rss: %.1f MiB" %
+          (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
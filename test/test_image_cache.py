@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+import unittest
+
+from image_cache import ImageCache
+from image_cache import IMAGE_CACHE_SUFFIX
+from image_class import IncUpdateImage
+from utils import OPTIONS_MANAGER
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        print("set up")
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.work_dir.name, "cache")
+        self.image_path = os.path.join(self.work_dir.name, "vendor.img")
+        self.map_path = os.path.join(self.work_dir.name, "vendor.map")
+        with open(self.image_path, 'wb') as w_f:
+            w_f.write(b'\0' * 4096 + b'\1' * 8192 + b'\0' * 4096 +
+                      b'\2' * 4096)
+        with open(self.map_path, 'w') as w_f:
+            w_f.write("/vendor/a 1-2\n")
+
+    def tearDown(self):
+        print("tear down")
+        OPTIONS_MANAGER.image_cache_dir = None
+        self.work_dir.cleanup()
+
+    def test_image_cache_round_trip(self):
+        """
+        A cached image restores the state of a parsed one.
+        :return:
+        """
+        image = IncUpdateImage(self.image_path, self.map_path)
+        image_cache = ImageCache(self.cache_dir, 1024 * 1024)
+        key = image_cache.get_key(self.image_path, self.map_path)
+        image_cache.store(image, key)
+
+        OPTIONS_MANAGER.image_cache_dir = self.cache_dir
+        cached_image = IncUpdateImage(self.image_path, self.map_path)
+        self.assertEqual(cached_image.care_block_range,
+                         image.care_block_range)
+        self.assertEqual(cached_image.extended_range, image.extended_range)
+        self.assertEqual(cached_image.offset_value_list,
+                         image.offset_value_list)
+        self.assertEqual(list(cached_image.file_map.items()),
+                         list(image.file_map.items()))
+        self.assertEqual(
+            cached_image.range_sha256(image.file_map["/vendor/a"]),
+            image.range_sha256(image.file_map["/vendor/a"]))
+        image.close()
+        cached_image.close()
+
+    def test_image_cache_invalid(self):
+        """
+        Corrupted entries are discarded, eviction keeps max_size.
+        :return:
+        """
+        image = IncUpdateImage(self.image_path, self.map_path)
+        image_cache = ImageCache(self.cache_dir, 1024 * 1024)
+        key = image_cache.get_key(self.image_path, self.map_path)
+        image_cache.store(image, key)
+        cache_path = image_cache.get_cache_path(key)
+        with open(cache_path, 'r+b') as w_f:
+            w_f.seek(-1, os.SEEK_END)
+            w_f.write(b'\0')
+        self.assertEqual(image_cache.load(image, key), False)
+        self.assertEqual(os.path.exists(cache_path), False)
+
+        ImageCache(self.cache_dir, 0).store(image, key)
+        self.assertEqual(
+            [file_name for file_name in os.listdir(self.cache_dir)
+             if file_name.endswith(IMAGE_CACHE_SUFFIX)], [])
+        image.close()
@@ -14,11 +14,17 @@
 # limitations under the License.
 
 import os
+import struct
 import subprocess
+import tempfile
 import unittest
+import zlib
+from hashlib import sha256
 
 from image_class import IncUpdateImage
 from image_class import FullUpdateImage
+from image_class import scan_nonzero_blocks
+from image_class import StagedImage
 from test.create_package_data import create_input_package
 from test.create_package_data import clear_package
 from script_generator import VerseScript
@@ -57,58 +63,6 @@ class TestImage(unittest.TestCase):
         self.assertEqual(check_re, True)
         clear_package("test_target_package")
 
-    def test_get_file_data(self):
-        """
-        get_file_data，file_pos is None
-        :return:
-        """
-        create_input_package("test_target_package", package_type="source")
-        with open('./test_target_package/vendor.img', 'rb') as wo_f:
-            f_r = wo_f
-        default_zero_block = ('\0' * 4096).encode()
-        fill_data = ('\0' * 4096).encode()[:4]
-        check_re = IncUpdateImage.get_file_data(
-            4096, 0, default_zero_block, 0,
-            None, fill_data, f_r)
-        self.assertEqual(check_re, default_zero_block)
-
-        fill_data = ('\1' * 4096).encode()[:4]
-        check_re = IncUpdateImage.get_file_data(
-            4096, 0, default_zero_block, 0,
-            None, fill_data, f_r)
-        self.assertEqual(check_re, None)
-
-        clear_resource()
-        f_r.close()
-        clear_package("test_target_package")
-
-    def test_get_blocks_list(self):
-        """
-        get_zero_nonzero_blocks_list，data == default_zero_block
-        :return:
-        """
-        default_zero_block = ('\0' * 4096).encode()
-        data = ('\0' * 4096).encode()
-        zero_blocks_list, nonzero_blocks_list, nonzero_groups_list = [], [], []
-        zero_blocks_list, nonzero_blocks_list, nonzero_groups_list = \
-            IncUpdateImage.get_zero_nonzero_blocks_list(
-                data, default_zero_block, 1, nonzero_blocks_list,
-                nonzero_groups_list, zero_blocks_list)
-        check_re = len(zero_blocks_list) != 0
-        self.assertEqual(check_re, True)
-
-        data = ('\1' * 4096).encode()
-        zero_blocks_list, nonzero_blocks_list, nonzero_groups_list = \
-            [], [0] * 4096, []
-        zero_blocks_list, nonzero_blocks_list, nonzero_groups_list = \
-            IncUpdateImage.get_zero_nonzero_blocks_list(
-                data, default_zero_block, 1, nonzero_blocks_list,
-                nonzero_groups_list, zero_blocks_list)
-        check_re = len(nonzero_groups_list) != 0
-        self.assertEqual(check_re, True)
-
-        clear_resource()
-
     def test_get_file_map(self):
         """
         get_file_map，if zero_blocks_list
@@ -181,3 +135,152 @@ class TestImage(unittest.TestCase):
 
         clear_resource()
         clear_package("test_target_package")
+
+    def test_image_mmap_close(self):
+        """
+        IncUpdateImage reads ranges from one mapping and releases it on close.
+        :return:
+        """
+        image_path = "./test_mmap_vendor.img"
+        map_path = "./test_mmap_vendor.map"
+        with open(image_path, 'wb') as w_f:
+            w_f.write(b'\0' * 4096 + b'\1' * 4096 + b'\2' * 4096)
+        with open(map_path, 'w') as w_f:
+            w_f.write("/vendor/file 1-2\n")
+        with IncUpdateImage(image_path, map_path) as image:
+            data = b''.join(image.get_ranges(BlocksManager("1-2")))
+        self.assertEqual(data, b'\1' * 4096 + b'\2' * 4096)
+        self.assertEqual(image.image_mmap, None)
+        os.remove(image_path)
+        os.remove(map_path)
+
+    def test_scan_nonzero_blocks(self):
+        """
+        scan_nonzero_blocks emits the boundaries of the nonzero runs.
+        :return:
+        """
+        block_size = 16
+        data = bytearray(2050 * block_size)
+        data[3 * block_size] = 1
+        data[4 * block_size + 15] = 1
+        data[1023 * block_size:1026 * block_size] = b'\1' * 3 * block_size
+        data[2049 * block_size] = 1
+        self.assertEqual(
+            scan_nonzero_blocks(memoryview(bytes(data)), 0, 2050, block_size),
+            [3, 5, 1023, 1026, 2049, 2050])
+        self.assertEqual(
+            scan_nonzero_blocks(memoryview(bytes(data)), 5, 1023, block_size),
+            [])
+
+    def test_range_sha256_cache(self):
+        """
+        range_sha256 and range_sha256_list share one digest cache.
+        :return:
+        """
+        image_path = "./test_sha_vendor.img"
+        map_path = "./test_sha_vendor.map"
+        with open(image_path, 'wb') as w_f:
+            w_f.write(b'\0' * 4096 + b'\1' * 4096 + b'\2' * 4096)
+        with open(map_path, 'w') as w_f:
+            w_f.write("/vendor/file 1-2\n")
+        with IncUpdateImage(image_path, map_path) as image:
+            digests = image.range_sha256_list(
+                [BlocksManager("2"), BlocksManager("1-2"), BlocksManager("2")])
+            self.assertEqual(digests[0], digests[2])
+            self.assertEqual(
+                digests[1], sha256(b'\1' * 4096 + b'\2' * 4096).hexdigest())
+            self.assertEqual(len(image.range_sha256_cache), 2)
+            self.assertEqual(image.range_sha256(BlocksManager("1-2")),
+                             digests[1])
+        os.remove(image_path)
+        os.remove(map_path)
+
+    def test_sparse_image(self):
+        """
+        A sparse image is read like the raw image it expands to.
+        :return:
+        """
+        chunks = [(0xCAC3, 1, b''), (0xCAC1, 2, b'\1' * 4096 + b'\0' * 4096),
+                  (0xCAC2, 2, b'\2\2\2\2'), (0xCAC2, 1, b'\0' * 4),
+                  (0xCAC1, 1, b'\3' * 4096)]
+        raw_data = b'\0' * 4096 + b'\1' * 4096 + b'\0' * 4096 + \
+            b'\2' * 8192 + b'\0' * 4096 + b'\3' * 4096
+        sparse_data = struct.pack("<I4H4I", 0xED26FF3A, 1, 0, 28, 12, 4096,
+                                  7, len(chunks) + 1, 0)
+        for chunk_type, chunk_blocks, chunk_data in chunks:
+            sparse_data += struct.pack("<2H2I", chunk_type, 0, chunk_blocks,
+                                       12 + len(chunk_data)) + chunk_data
+        sparse_data += struct.pack("<2H2I", 0xCAC4, 0, 0, 16) + \
+            struct.pack("<I", zlib.crc32(raw_data))
+        map_path = "./test_sparse_vendor.map"
+        with open(map_path, 'w') as w_f:
+            w_f.write("/vendor/a 1-3\n/vendor/b 6\n")
+        images = []
+        for image_path, data in (("./test_sparse_vendor.img", sparse_data),
+                                 ("./test_raw_vendor.img", raw_data)):
+            with open(image_path, 'wb') as w_f:
+                w_f.write(data)
+            images.append(IncUpdateImage(image_path, map_path))
+        sparse_image, raw_image = images
+        self.assertEqual(sparse_image.total_blocks, 7)
+        self.assertEqual(sparse_image.care_block_range,
+                         raw_image.care_block_range)
+        self.assertEqual(sparse_image.file_map, raw_image.file_map)
+        all_blocks = BlocksManager("0-6")
+        self.assertEqual(b''.join(sparse_image.get_ranges(all_blocks)),
+                         raw_data)
+        file_blocks = sparse_image.file_map["/vendor/a"]
+        self.assertEqual(sparse_image.range_sha256(file_blocks),
+                         raw_image.range_sha256(file_blocks))
+        for image in images:
+            image.close()
+            os.remove(image.image_path)
+        os.remove(map_path)
+
+        with open("./test_sparse_vendor.img", 'wb') as w_f:
+            w_f.write(sparse_data[:-4] + struct.pack("<I", 0))
+        with open(map_path, 'w') as w_f:
+            w_f.write("/vendor/a 1-3\n")
+        with self.assertRaises(RuntimeError):
+            IncUpdateImage("./test_sparse_vendor.img", map_path)
+        os.remove("./test_sparse_vendor.img")
+        os.remove(map_path)
+
+    def test_staged_image(self):
+        """
+        Full images are staged by copy and read lazily.
+        :return:
+        """
+        image_path = "./test_staged_vendor.img"
+        image_data = bytes(range(256)) * 64
+        with open(image_path, 'wb') as w_f:
+            w_f.write(image_data)
+        with tempfile.NamedTemporaryFile(dir=".", mode='wb') as file_obj:
+            FullUpdateImage.stage_image_file(image_path, file_obj)
+            staged_image = StagedImage(file_obj.name)
+            self.assertEqual(len(staged_image), len(image_data))
+            self.assertEqual(bytes(staged_image.read(100, 8)),
+                             image_data[100:108])
+            self.assertEqual(staged_image.get_digest(),
+                             sha256(image_data).hexdigest())
+        os.remove(image_path)
+
+    def test_apply_remain_range_groups(self):
+        """
+        Unmapped nonzero blocks are grouped MAX_BLOCKS_PER_GROUP // 2 at a time.
+        :return:
+        """
+        image_path = "./test_remain_vendor.img"
+        map_path = "./test_remain_vendor.map"
+        with open(image_path, 'wb') as w_f:
+            w_f.write(b'\0' * 4096 + b'\1' * 4096 * 1100)
+        with open(map_path, 'w') as w_f:
+            w_f.write("/vendor/a 1-10\n")
+        with IncUpdateImage(image_path, map_path) as image:
+            self.assertEqual(
+                [(name, blocks.range_data) for name, blocks in
+                 image.file_map.items() if name.startswith("__NONZERO")],
+                [("__NONZERO-0", (11, 523)), ("__NONZERO-1", (523, 1035)),
+                 ("__NONZERO-2", (1035, 1101))])
+        os.remove(image_path)
+        os.remove(map_path)
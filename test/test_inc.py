@@ -12,11 +12,27 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
+import gc
+import os
+import struct
+import tempfile
 import unittest
+import weakref
 
 from blocks_manager import BlocksManager
+from blocks_manager import BlocksAccumulator
+from blocks_manager import BlockBitmap
+from blocks_manager import BlocksOverlapIndex
+from blocks_manager import clip_blocks_in_order
+from blocks_manager import iter_overlap_pairs
+from gigraph_process import GigraphProcess
+from gigraph_process import StashOrder
+from image_class import IncUpdateImage
 from transfers_manager import ActionInfo
+from transfers_manager import TransfersManager
 from transfers_manager import ActionType
+from transfers_manager import FileSimilarityIndex
 
 
 class TestUtils(unittest.TestCase):
@@ -39,6 +55,280 @@ class TestUtils(unittest.TestCase):
 
         check_re2 = bm1.get_map_within(bm2).range_data
         self.assertEqual(check_re2, (0, 5))
+        self.assertEqual(bm1.range_view().tolist(), [5, 11])
+        self.assertEqual(list(bm1), [(5, 11)])
+
+    def test_blocks_manager_interned(self):
+        """
+        Equal range data gives one instance and memoized results.
+        :return:
+        """
+        bm1 = BlocksManager("5-10 20")
+        self.assertIs(bm1, BlocksManager(range_data=[5, 11, 20, 21]))
+        self.assertIs(copy.deepcopy(bm1), bm1)
+        self.assertEqual({bm1: "a"}[BlocksManager("5-10 20")], "a")
+        bm2 = BlocksManager("8-30")
+        self.assertIs(bm1.get_intersect_with_other(bm2),
+                      bm1.get_intersect_with_other(bm2))
+        self.assertIs(bm1.get_subtract_with_other(bm2), BlocksManager("5-7"))
+        with self.assertRaises(AttributeError):
+            bm1.monotonic = False
+        # Once the memo is cleared, it no longer keeps operands alive.
+        bm_ref = weakref.ref(bm2)
+        del bm2
+        gc.collect()
+        self.assertIsNotNone(bm_ref())
+        BlocksManager.clear_memo()
+        gc.collect()
+        self.assertIsNone(bm_ref())
+
+    def test_blocks_manager_set_algebra(self):
+        """
+        Cases for BlocksManager intersect, subtract, union and overlaps
+        :return:
+        """
+        bm1 = BlocksManager("0-9 20-29 40-49")
+        bm2 = BlocksManager("5-24 30-39 49")
+        self.assertEqual(bm1.get_intersect_with_other(bm2).range_data,
+                         (5, 10, 20, 25, 49, 50))
+        self.assertEqual(bm1.get_subtract_with_other(bm2).range_data,
+                         (0, 5, 25, 30, 40, 49))
+        self.assertEqual(bm1.get_union_with_other(bm2).range_data,
+                         (0, 50))
+        self.assertEqual(bm1.is_overlaps(bm2), True)
+        self.assertEqual(bm1.is_overlaps(BlocksManager("10-19")), False)
+
+        bm3 = BlocksManager("2-3 8-9 30")
+        self.assertEqual(bm3.extend_value_to_blocks(2).range_data,
+                         (0, 12, 28, 33))
+
+    def test_blocks_manager_text(self):
+        """
+        Cases for BlocksManager text parsing and raw strings
+        :return:
+        """
+        bm1 = BlocksManager("30-39 0-0 5 6-9")
+        self.assertEqual(bm1.range_data, (0, 1, 5, 10, 30, 40))
+        raw_string = bm1.to_string_raw()
+        self.assertEqual(raw_string, "6,0,1,5,10,30,40")
+        self.assertEqual(BlocksManager.from_string_raw(raw_string), bm1)
+
+    def test_blocks_manager_split(self):
+        """
+        Cases for BlocksManager split_first_block_obj and split_by_block_count
+        :return:
+        """
+        bm1 = BlocksManager("0-9 20-29")
+        first, remain = bm1.split_first_block_obj(12)
+        self.assertEqual(first.range_data, (0, 10, 20, 22))
+        self.assertEqual(remain.range_data, (22, 30))
+        self.assertEqual(bm1.get_first_block_obj(10).range_data, (0, 10))
+
+        pieces = [each.range_data for each in bm1.split_by_block_count(8)]
+        self.assertEqual(pieces, [(0, 8), (8, 10, 20, 26), (26, 30)])
+
+    def test_blocks_manager_bulk(self):
+        """
+        Cases for BlocksManager union_all, intersect_all and BlocksAccumulator
+        :return:
+        """
+        blocks_list = [BlocksManager("0-9"), BlocksManager("5-14"),
+                       BlocksManager("8-20 30")]
+        self.assertEqual(BlocksManager.union_all(blocks_list).range_data,
+                         (0, 21, 30, 31))
+        self.assertEqual(BlocksManager.intersect_all(blocks_list).range_data,
+                         (8, 10))
+        self.assertEqual(BlocksManager.intersect_all([]).size(), 0)
+
+        accumulator = BlocksAccumulator()
+        for blocks in blocks_list:
+            accumulator.add(blocks)
+        self.assertEqual(accumulator.get_blocks().range_data, (0, 21, 30, 31))
+
+    def test_block_bitmap(self):
+        """
+        Cases for BlockBitmap
+        :return:
+        """
+        bm1 = BlocksManager("0-9 20-29")
+        bm2 = BlocksManager("5-24")
+        bitmap1 = BlockBitmap.from_blocks(bm1, 32)
+        bitmap2 = BlockBitmap.from_blocks(bm2, 32)
+        self.assertEqual(bitmap1.to_blocks(), bm1)
+        self.assertEqual(bitmap1.size(), 20)
+        self.assertEqual(bitmap1.get_union_with_other(bitmap2).to_blocks(),
+                         bm1.get_union_with_other(bm2))
+        self.assertEqual(bitmap1.get_intersect_with_other(bitmap2).to_blocks(),
+                         bm1.get_intersect_with_other(bm2))
+        self.assertEqual(bitmap1.get_subtract_with_other(bitmap2).to_blocks(),
+                         bm1.get_subtract_with_other(bm2))
+        self.assertEqual(bitmap1.get_complement().to_blocks().range_data,
+                         (10, 20, 30, 32))
+        self.assertEqual(
+            BlockBitmap.from_block_numbers([3, 4, 40], 8).to_blocks().range_data,
+            (3, 5))
+
+    def test_blocks_overlap_index(self):
+        """
+        Cases for BlocksOverlapIndex
+        :return:
+        """
+        overlap_index = BlocksOverlapIndex([
+            ("a", BlocksManager("0-9 40-49")),
+            ("b", BlocksManager("5-14")),
+            ("c", BlocksManager("100-109"))])
+        query = BlocksManager("8-41")
+        self.assertEqual(list(overlap_index.get_overlap_sizes(query).items()),
+                         [("a", 4), ("b", 7)])
+        overlap_blocks = overlap_index.get_overlap_blocks(query)
+        self.assertEqual(overlap_blocks["a"].range_data, (8, 10, 40, 42))
+        self.assertEqual(
+            len(overlap_index.get_overlap_sizes(BlocksManager("50-99"))), 0)
+
+    def test_clip_blocks_in_order(self):
+        """
+        Cases for clip_blocks_in_order
+        :return:
+        """
+        clipped_list, remain = clip_blocks_in_order(
+            [BlocksManager("5-14"), BlocksManager("0-9 30-34"),
+             BlocksManager("12-20")],
+            BlocksManager("1-18 30-31"))
+        self.assertEqual([blocks.range_data for blocks in clipped_list],
+                         [(5, 15), (1, 5, 30, 32), (15, 19)])
+        self.assertEqual(remain.size(), 0)
+
+    def test_iter_overlap_pairs(self):
+        """
+        Cases for iter_overlap_pairs
+        :return:
+        """
+        overlaps = sorted(iter_overlap_pairs(
+            [BlocksManager("0-9 40-49"), BlocksManager("5-14")],
+            [BlocksManager("8-41"), BlocksManager("100-109")]))
+        self.assertEqual(overlaps,
+                         [(0, 0, 8, 10), (0, 0, 40, 42), (1, 0, 8, 15)])
+
+    def test_stash_order(self):
+        """
+        Cycles are broken on the edge that stashes fewer blocks.
+        :return:
+        """
+        action_a = ActionInfo(ActionType.DIFFERENT, "/a", "/a",
+                              BlocksManager("0-9"), BlocksManager("20-22"))
+        action_b = ActionInfo(ActionType.DIFFERENT, "/b", "/b",
+                              BlocksManager("20-29"), BlocksManager("0-9"))
+        action_c = ActionInfo(ActionType.NEW, "/c", None,
+                              BlocksManager("40-49"), None)
+        graph_process = GigraphProcess(
+            [action_a, action_b, action_c], None, None)
+        self.assertEqual(graph_process.actions_list,
+                         [action_b, action_a, action_c])
+        self.assertEqual(
+            StashOrder.get_stash_cost(graph_process.actions_list), 3)
+        components, component_id = \
+            StashOrder(graph_process).get_components()
+        self.assertEqual(sorted(components), [[0, 1], [2]])
+        self.assertEqual(component_id[0], component_id[1])
+
+    def test_action_graph(self):
+        """
+        ActionInfo reads its edges from the action graph.
+        :return:
+        """
+        action_a = ActionInfo(ActionType.DIFFERENT, "/a", "/a",
+                              BlocksManager("0-9"), BlocksManager("20-22"))
+        action_b = ActionInfo(ActionType.DIFFERENT, "/b", "/b",
+                              BlocksManager("20-29"), BlocksManager("0-9"))
+        graph_process = GigraphProcess([action_a, action_b], None, None)
+        action_graph = graph_process.action_graph
+        self.assertEqual(list(action_graph.get_child_edges(0)), [(1, 3)])
+        self.assertEqual(list(action_graph.get_parent_edges(0)), [(1, 10)])
+        self.assertEqual(list(action_a.child.items()), [(action_b, 3)])
+        graph_process.stash_process()
+        self.assertEqual(list(action_a.child.items()), [])
+        self.assertEqual(list(action_a.parent.items()), [(action_b, None)])
+        self.assertEqual(list(action_b.child.items()), [(action_a, None)])
+        self.assertEqual(list(action_b.parent.items()), [])
+
+    def test_revise_stash_size(self):
+        """
+        Stashes above the budget turn their consumers into NEW.
+        :return:
+        """
+        for data_size, max_stash_blocks, type_str in (
+                (4096 * 3, 3, ActionType.DIFFERENT),
+                (4096 * 2, 0, ActionType.NEW)):
+            action_a = ActionInfo(
+                ActionType.DIFFERENT, "/a", "/a",
+                BlocksManager("0-9"), BlocksManager("20-22"))
+            action_b = ActionInfo(
+                ActionType.DIFFERENT, "/b", "/b",
+                BlocksManager("20-29"), BlocksManager("0-9"))
+            graph_process = GigraphProcess([action_a, action_b], None, None)
+            graph_process.data_size = data_size
+            graph_process.stash_process()
+            self.assertEqual(graph_process.max_stash_blocks,
+                             max_stash_blocks)
+            self.assertEqual(action_a.type_str, type_str)
+            self.assertEqual(len(action_b.stash_before),
+                             len(action_a.use_stash))
+
+    def test_stash_sorts_src_blocks(self):
+        """
+        src blocks in target order are sorted once a stash reads them.
+        :return:
+        """
+        action_a = ActionInfo(
+            ActionType.DIFFERENT, "/a", "/a",
+            BlocksManager("0-9"), BlocksManager(range_data=(25, 30, 20, 25)))
+        action_b = ActionInfo(
+            ActionType.DIFFERENT, "/b", "/b",
+            BlocksManager("20-29"), BlocksManager(range_data=(5, 10, 0, 5)))
+        graph_process = GigraphProcess([action_a, action_b], None, None)
+        graph_process.stash_process()
+        first_action, stashed_action = graph_process.actions_list
+        self.assertEqual(len(stashed_action.use_stash), 1)
+        self.assertTrue(stashed_action.src_block_set.monotonic)
+        self.assertFalse(first_action.src_block_set.monotonic)
+
+    def test_zero_action_not_stashed(self):
+        """
+        A ZERO action does not read its src blocks, so they are not stashed
+        when it goes after the action writing them.
+        :return:
+        """
+        action_zero = ActionInfo(
+            ActionType.ZERO, "__ZERO", "__ZERO",
+            BlocksManager("30-39"), BlocksManager("0-9"))
+        action_b = ActionInfo(
+            ActionType.DIFFERENT, "/b", "/b",
+            BlocksManager("0-9"), BlocksManager("30-39"))
+        graph_process = GigraphProcess([action_zero, action_b], None, None)
+        graph_process.stash_process()
+        self.assertEqual(graph_process.actions_list, [action_b, action_zero])
+        self.assertEqual(action_b.stash_before, [])
+        self.assertEqual(action_zero.use_stash, [])
+        self.assertEqual(graph_process.max_stash_blocks, 0)
+        self.assertEqual(action_zero.parent, {action_b: None})
+
+    def test_file_similarity_index(self):
+        """
+        Cases for FileSimilarityIndex
+        :return:
+        """
+        lines = [b"symbol_%04d_value\n" % i for i in range(400)]
+        similarity_index = FileSimilarityIndex()
+        similarity_index.add("libfoo.so.1", b"".join(lines))
+        similarity_index.add("libbar.so", b"".join(
+            b"other_%04d_content\n" % i for i in range(400)))
+        changed = b"".join(lines[:380]) + b"".join(
+            b"added_%04d_symbol\n" % i for i in range(20))
+        name, score = similarity_index.find(changed)
+        self.assertEqual(name, "libfoo.so.1")
+        self.assertGreater(score, 0.8)
+        self.assertEqual(similarity_index.find(b"unrelated content\n")[0],
+                         None)
 
     def test_action_info(self):
         """
@@ -51,3 +341,159 @@ class TestUtils(unittest.TestCase):
             ActionType.NEW, "test.txt", "test.txt", bm1, bm2)
         check_re = action_info.net_stash_change()
         self.assertEqual(check_re, 0)
+
+    def test_find_content_blocks(self):
+        """
+        Renamed target files are diffed against the source blocks
+        holding their data.
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as work_dir:
+            images = []
+            for name, blocks, map_text in (
+                    ("src", b"ABC", "/system/a 1-3\n"),
+                    ("tgt", b"XABC", "/system/x 1\n/system/b 2-4\n")):
+                image_path = os.path.join(work_dir, name + ".img")
+                map_path = os.path.join(work_dir, name + ".map")
+                with open(image_path, 'wb') as w_f:
+                    w_f.write(b'\0' * 4096)
+                    for each_byte in blocks:
+                        w_f.write(bytes([each_byte]) * 4096)
+                with open(map_path, 'w') as w_f:
+                    w_f.write(map_text)
+                images.append(IncUpdateImage(image_path, map_path))
+            src_image, tgt_image = images
+            transfers_manager = TransfersManager("system", tgt_image, src_image)
+            transfers_manager.find_process_needs()
+            actions = {action.tgt_name: action for action in
+                       transfers_manager.get_action_list()}
+            self.assertEqual(actions["/system/x"].type_str, ActionType.NEW)
+            self.assertEqual(actions["/system/b"].type_str,
+                             ActionType.DIFFERENT)
+            self.assertEqual(actions["/system/b"].src_block_set.range_data,
+                             (1, 4))
+            self.assertEqual(actions["/system/b"].src_name, "/system/a")
+            self.assertEqual(
+                tgt_image.range_sha256(actions["/system/b"].tgt_block_set),
+                src_image.range_sha256(actions["/system/b"].src_block_set))
+            src_image.close()
+            tgt_image.close()
+
+    def test_find_content_blocks_order(self):
+        """
+        Source blocks matched by content keep the target order, repeated
+        target data maps to the same source block again.
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as work_dir:
+            images = []
+            for name, blocks, map_text in (
+                    ("src", b"ABCD", "/system/a 1-4\n"),
+                    ("tgt", b"CDAAB", "/system/b 1-5\n")):
+                image_path = os.path.join(work_dir, name + ".img")
+                map_path = os.path.join(work_dir, name + ".map")
+                with open(image_path, 'wb') as w_f:
+                    w_f.write(b'\0' * 4096)
+                    for each_byte in blocks:
+                        w_f.write(bytes([each_byte]) * 4096)
+                with open(map_path, 'w') as w_f:
+                    w_f.write(map_text)
+                images.append(IncUpdateImage(image_path, map_path))
+            src_image, tgt_image = images
+            transfers_manager = TransfersManager("system", tgt_image, src_image)
+            src_blocks = transfers_manager.find_content_blocks(
+                BlocksManager("1-5"))
+            self.assertEqual(src_blocks.range_data, (3, 5, 1, 2, 1, 3))
+            self.assertEqual(tgt_image.range_sha256(BlocksManager("1-5")),
+                             src_image.range_sha256(src_blocks))
+            src_image.close()
+            tgt_image.close()
+
+    def test_find_content_blocks_sparse(self):
+        """
+        Blocks of a sparse source image are matched at their block
+        numbers, not at their offsets in the sparse file.
+        :return:
+        """
+        with tempfile.TemporaryDirectory() as work_dir:
+            src_path = os.path.join(work_dir, "src.img")
+            chunks = [(0xCAC3, 2, b''), (0xCAC1, 3, b'A' * 4096 +
+                                         b'B' * 4096 + b'C' * 4096),
+                      (0xCAC2, 1, b'\5' * 4)]
+            with open(src_path, 'wb') as w_f:
+                w_f.write(struct.pack("<I4H4I", 0xED26FF3A, 1, 0, 28, 12,
+                                      4096, 6, len(chunks), 0))
+                for chunk_type, chunk_blocks, chunk_data in chunks:
+                    w_f.write(struct.pack("<2H2I", chunk_type, 0,
+                                          chunk_blocks, 12 + len(chunk_data)))
+                    w_f.write(chunk_data)
+            tgt_path = os.path.join(work_dir, "tgt.img")
+            with open(tgt_path, 'wb') as w_f:
+                w_f.write(b'\0' * 4096)
+                for each_byte in b"XABC\5":
+                    w_f.write(bytes([each_byte]) * 4096)
+            images = []
+            for image_path, map_text in (
+                    (src_path, "/system/a 2-4\n/system/f 5\n"),
+                    (tgt_path, "/system/x 1\n/system/b 2-4\n/system/y 5\n")):
+                map_path = image_path[:-4] + ".map"
+                with open(map_path, 'w') as w_f:
+                    w_f.write(map_text)
+                images.append(IncUpdateImage(image_path, map_path))
+            src_image, tgt_image = images
+            transfers_manager = TransfersManager("system", tgt_image, src_image)
+            transfers_manager.find_process_needs()
+            actions = {action.tgt_name: action for action in
+                       transfers_manager.get_action_list()}
+            self.assertEqual(actions["/system/x"].type_str, ActionType.NEW)
+            self.assertEqual(
+                [(actions[name].src_name,
+                  actions[name].src_block_set.range_data)
+                 for name in ("/system/b", "/system/y")],
+                [("/system/a", (2, 5)), ("/system/f", (5, 6))])
+            self.assertIsNone(src_image.get_block_data(0))
+            self.assertIsNone(src_image.get_block_data(6))
+            self.assertEqual(bytes(src_image.get_block_data(3)), b'B' * 4096)
+            src_image.close()
+            tgt_image.close()
+
+    def test_split_large_actions(self):
+        """
+        Large DIFFERENT actions are split into paired pieces in order.
+        :return:
+        """
+        transfers_manager = TransfersManager("system", None, None)
+        transfers_manager.action_file_list = [
+            ActionInfo(ActionType.DIFFERENT, "/a", "/a",
+                       BlocksManager("0-5 10-15"), BlocksManager("20-29")),
+            ActionInfo(ActionType.NEW, "/b", None,
+                       BlocksManager("30-49"), None),
+            ActionInfo(ActionType.DIFFERENT, "/c", "/c",
+                       BlocksManager("50-52"), BlocksManager("60-62")),
+            ActionInfo(ActionType.DIFFERENT, "/d", "/d",
+                       BlocksManager("100-110"), BlocksManager("200-204")),
+            ActionInfo(ActionType.DIFFERENT, "/e", "/e",
+                       BlocksManager("300-311"), BlocksManager("400-402"))]
+        transfers_manager.split_large_actions(0)
+        self.assertEqual(len(transfers_manager.get_action_list()), 5)
+        transfers_manager.split_large_actions(4)
+        actions = transfers_manager.get_action_list()
+        self.assertEqual([action.tgt_name for action in actions],
+                         ["/a-0", "/a-1", "/a-2", "/b", "/c", "/d-0", "/d-1",
+                          "/e-0", "/e-1", "/e-2"])
+        self.assertEqual([action.tgt_block_set.range_data
+                          for action in actions[:3]],
+                         [(0, 4), (4, 6, 10, 12), (12, 16)])
+        self.assertEqual([action.src_block_set.range_data
+                          for action in actions[:3]],
+                         [(20, 24), (24, 28), (28, 30)])
+        # The short remainder is folded into the last piece.
+        self.assertEqual([(action.tgt_block_set.range_data,
+                           action.src_block_set.range_data)
+                          for action in actions[5:7]],
+                         [((100, 104), (200, 204)), ((104, 111), (204, 205))])
+        # Pieces past the end of the src blocks are written as NEW.
+        self.assertEqual([(action.type_str, action.src_block_set.range_data)
+                          for action in actions[7:]],
+                         [(ActionType.DIFFERENT, (400, 403)),
+                          (ActionType.NEW, ()), (ActionType.NEW, ())])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import unittest
+
+import transfer_list
+from blocks_manager import BlocksManager
+from transfer_list import DiffCommand
+from transfer_list import EraseCommand
+from transfer_list import FreeCommand
+from transfer_list import MoveCommand
+from transfer_list import NewCommand
+from transfer_list import StashCommand
+from transfer_list import ZeroCommand
+from transfer_list import get_transfer_list_text
+from transfer_list import write_transfer_list
+
+
+class TestTransferList(unittest.TestCase):
+
+    def setUp(self):
+        print("set up")
+
+    def tearDown(self):
+        print("tear down")
+
+    def test_transfer_list_text(self):
+        """
+        Commands are written after the header with the totals.
+        :return:
+        """
+        commands = [
+            EraseCommand(BlocksManager("30-39")),
+            StashCommand("aa", BlocksManager("0-1")),
+            MoveCommand("bb", BlocksManager("2-3"), "2 2,0,2"),
+            DiffCommand("bsdiff", 0, 10, "cc", "dd",
+                        BlocksManager("4"), "1 2,5,6"),
+            FreeCommand("aa"),
+            NewCommand(BlocksManager("5")),
+            NewCommand(BlocksManager("6"), "ee"),
+            ZeroCommand(BlocksManager("7-8"))]
+        self.assertEqual(
+            get_transfer_list_text(1, 7, 2, commands),
+            "1\n7\n0\n2\n"
+            "erase 2,30,40\n"
+            "stash aa 2,0,2\n"
+            "move bb 2,2,4 2 2,0,2\n"
+            "bsdiff 0 10 cc dd 2,4,5 1 2,5,6\n"
+            "free aa\n"
+            "new 2,5,6\n"
+            "new ee 2,6,7\n"
+            "zero 2,7,9\n")
+
+    def test_write_transfer_list(self):
+        """
+        The streamed file matches the text in any batch size.
+        :return:
+        """
+        commands = [ZeroCommand(BlocksManager(range_data=[i, i + 1]))
+                    for i in range(10)]
+        batch_size = transfer_list.TRANSFER_WRITE_BATCH
+        transfer_list.TRANSFER_WRITE_BATCH = 3
+        try:
+            file_obj = io.BytesIO()
+            write_transfer_list(file_obj, 1, 10, 0, commands)
+        finally:
+            transfer_list.TRANSFER_WRITE_BATCH = batch_size
+        self.assertEqual(file_obj.getvalue().decode(),
+                         get_transfer_list_text(1, 10, 0, commands))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Huawei Device Co., Ltd.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Description : commands of transfer.list and the writer streaming them
+"""
+from collections import namedtuple
+
+# Number of command lines encoded and written at a time.
+TRANSFER_WRITE_BATCH = 4096
+
+
+class MoveCommand(namedtuple(
+        "MoveCommand", ["tgt_hash", "tgt_blocks", "src_str"])):
+    __slots__ = ()
+
+    def to_string(self):
+        return "move %s %s %s\n" % (
+            self.tgt_hash, self.tgt_blocks.to_string_raw(), self.src_str)
+
+
+class DiffCommand(namedtuple(
+        "DiffCommand", ["diff_type", "offset", "length", "src_hash",
+                        "tgt_hash", "tgt_blocks", "src_str"])):
+    """
+    bsdiff or pkgdiff command, diff_type holds the command name.
+    """
+    __slots__ = ()
+
+    def to_string(self):
+        return "%s %d %d %s %s %s %s\n" % (
+            self.diff_type, self.offset, self.length, self.src_hash,
+            self.tgt_hash, self.tgt_blocks.to_string_raw(), self.src_str)
+
+
+class NewCommand(namedtuple(
+        "NewCommand", ["tgt_blocks", "data_hash"], defaults=[None])):
+    """
+    new command, data_hash is only set for streaming update.
+    """
+    __slots__ = ()
+
+    def to_string(self):
+        if self.data_hash is None:
+            return "new %s\n" % self.tgt_blocks.to_string_raw()
+        return "new %s %s\n" % (self.data_hash,
+                                self.tgt_blocks.to_string_raw())
+
+
+class ZeroCommand(namedtuple("ZeroCommand", ["tgt_blocks"])):
+    __slots__ = ()
+
+    def to_string(self):
+        return "zero %s\n" % self.tgt_blocks.to_string_raw()
+
+
+class EraseCommand(namedtuple("EraseCommand", ["tgt_blocks"])):
+    __slots__ = ()
+
+    def to_string(self):
+        return "erase %s\n" % self.tgt_blocks.to_string_raw()
+
+
+class StashCommand(namedtuple("StashCommand", ["stash_hash", "src_blocks"])):
+    __slots__ = ()
+
+    def to_string(self):
+        return "stash %s %s\n" % (self.stash_hash,
+                                  self.src_blocks.to_string_raw())
+
+
+class FreeCommand(namedtuple("FreeCommand", ["stash_hash"])):
+    __slots__ = ()
+
+    def to_string(self):
+        return "free %s\n" % self.stash_hash
+
+
+def iter_transfer_lines(version, total_blocks_count, max_stashed_blocks,
+                        commands):
+    """
+    Yield the lines of transfer.list, the header first.
+    :param version: transfer.list version
+    :param total_blocks_count: number of blocks written by the commands
+    :param max_stashed_blocks: max number of blocks stashed at a time
+    :param commands: command list
+    """
+    yield "%d\n%d\n0\n%d\n" % (version, total_blocks_count,
+                                max_stashed_blocks)
+    for command in commands:
+        yield command.to_string()
+
+
+def get_transfer_list_text(*args):
+    """
+    Get the whole transfer.list as a string.
+    :param args: arguments of iter_transfer_lines
+    :return: transfer.list content
+    """
+    return "".join(iter_transfer_lines(*args))
+
+
+def write_transfer_list(file_obj, *args):
+    """
+    Write transfer.list to a binary file object, TRANSFER_WRITE_BATCH
+    lines at a time.
+    :param file_obj: binary file object
+    :param args: arguments of iter_transfer_lines
+    """
+    lines = []
+    for line in iter_transfer_lines(*args):
+        lines.append(line)
+        if len(lines) >= TRANSFER_WRITE_BATCH:
+            file_obj.write("".join(lines).encode())
+            lines = []
+    if lines:
+        file_obj.write("".join(lines).encode())
@@ -17,19 +17,33 @@
 Description: create actions_list and transfer package
 """
 
+import heapq
 import os
 import re
+import zlib
 from collections import OrderedDict
 from enum import Enum
 
 from blocks_manager import BlocksManager
+from blocks_manager import BlocksOverlapIndex
 from log_exception import UPDATE_LOGGER
 from utils import FILE_MAP_ZERO_KEY
 from utils import FILE_MAP_COPY_KEY
+from utils import FILE_MAP_NONZERO_KEY
 from utils import OptionsManager
 
 VERSION_NAME_RE = r"[0-9]+"
 REPLACE_CONTENT = "#"
+# Share of a target file's blocks that must be found in the source image
+# before it is diffed against those blocks instead of written as NEW.
+CONTENT_MATCH_RATIO = 0.5
+# Content sketches used by the similarity matcher: files are cut into
+# pieces at zero bytes and newlines, and the SKETCH_SIZE smallest piece
+# crc32 values are kept (a bottom-k MinHash).
+SKETCH_SPLIT_RE = re.compile(rb"[\x00\n]+")
+SKETCH_MIN_PIECE = 8
+SKETCH_SIZE = 128
+SIMILARITY_THRESHOLD = 0.5
 
 
 class ActionType(Enum):
@@ -52,14 +66,30 @@ class ActionInfo:
             self.src_block_set = src_block_set
         else:
             self.src_block_set = BlocksManager()
-        self.child = OrderedDict()
-        self.parent = OrderedDict()
+        # Once GigraphProcess builds the action graph, the edges are read
+        # from it by action id.
+        self.graph = None
+        self.action_id = None
+        self.__child = OrderedDict()
+        self.__parent = OrderedDict()
         self.stash_before = []
         self.use_stash = []
 
+    @property
+    def child(self):
+        if self.graph is not None:
+            return self.graph.get_child_dict(self.action_id)
+        return self.__child
+
+    @property
+    def parent(self):
+        if self.graph is not None:
+            return self.graph.get_parent_dict(self.action_id)
+        return self.__parent
+
     def get_max_block_number(self):
         if self.src_block_set and self.src_block_set.size() != 0:
-            return max(self.src_block_set.range_data)
+            return max(self.src_block_set.range_view())
         else:
             return 0
 
@@ -68,6 +98,66 @@ class ActionInfo:
                 sum(sr.size() for (_, sr) in self.use_stash))
 
 
+class FileSimilarityIndex(object):
+    """
+    Index of file content sketches, finds the most similar indexed file.
+    """
+
+    def __init__(self):
+        self.sketches = {}
+        self.sketch_owners = {}
+
+    @staticmethod
+    def get_sketch(data):
+        """
+        Get the bottom-k sketch of data.
+        :param data: file content
+        :return: frozenset of the smallest piece hashes
+        """
+        tokens = set(zlib.crc32(piece) for piece in SKETCH_SPLIT_RE.split(data)
+                     if len(piece) >= SKETCH_MIN_PIECE)
+        return frozenset(heapq.nsmallest(SKETCH_SIZE, tokens))
+
+    @staticmethod
+    def get_similarity(sketch_a, sketch_b):
+        """
+        Estimate the Jaccard similarity of two files from their sketches.
+        """
+        union_bottom = heapq.nsmallest(SKETCH_SIZE, sketch_a | sketch_b)
+        if not union_bottom:
+            return 0
+        shared = sum(1 for value in union_bottom
+                     if value in sketch_a and value in sketch_b)
+        return shared / len(union_bottom)
+
+    def add(self, name, data):
+        sketch = self.get_sketch(data)
+        self.sketches[name] = sketch
+        for value in sketch:
+            self.sketch_owners.setdefault(value, []).append(name)
+
+    def find(self, data, threshold=SIMILARITY_THRESHOLD):
+        """
+        Find the indexed file most similar to data.
+        :param data: file content
+        :param threshold: lowest similarity accepted
+        :return: (name, similarity), name is None if none passes threshold
+        """
+        sketch = self.get_sketch(data)
+        candidates = OrderedDict()
+        for value in sorted(sketch):
+            for name in self.sketch_owners.get(value, ()):
+                candidates[name] = True
+        best_name, best_score = None, 0
+        for name in candidates:
+            score = self.get_similarity(sketch, self.sketches[name])
+            if score > best_score:
+                best_name, best_score = name, score
+        if best_score < threshold:
+            return None, best_score
+        return best_name, best_score
+
+
 class TransfersManager(object):
     def __init__(self, partition, tgt_img_obj, src_img_obj,
                  disable_img_diff=False):
@@ -78,7 +168,10 @@ class TransfersManager(object):
 
         self.action_file_list = []
         self.no_copy_list = []
-        
+        self.src_block_index = None
+        self.src_file_index = None
+        self.src_similarity_index = None
+
     @staticmethod
     def simplify_file_name(file_name):
         base_name = os.path.basename(file_name)
@@ -139,6 +232,19 @@ class TransfersManager(object):
             if src_file_name:
                 max_size = self.process_diff_action(src_file_name, tgt_blocks, max_size, tgt_file_name)
                 continue
+            src_blocks = self.find_content_blocks(tgt_blocks)
+            if src_blocks is not None:
+                UPDATE_LOGGER.print_log("Apply DIFF type by content!")
+                max_size = self.process_content_action(
+                    src_blocks, tgt_blocks, max_size, tgt_file_name)
+                continue
+            if OPTIONS_MANAGER.similarity_match:
+                src_file_name = self.get_similar_file_name(tgt_blocks)
+                if src_file_name:
+                    UPDATE_LOGGER.print_log("Apply DIFF type by similarity!")
+                    max_size = self.process_diff_action(
+                        src_file_name, tgt_blocks, max_size, tgt_file_name)
+                    continue
             self.action_file_list.append(
                 ActionInfo(ActionType.NEW, tgt_file_name,
                            None, tgt_blocks, None))
@@ -159,6 +265,181 @@ class TransfersManager(object):
             self.no_copy_list.append(tgt_blocks)
         return max_size 
     
+    def process_content_action(self, src_blocks, tgt_blocks, max_size,
+                               tgt_file_name):
+        action_info = ActionInfo(
+            ActionType.DIFFERENT, tgt_file_name,
+            self.get_content_file_name(src_blocks), tgt_blocks, src_blocks)
+        max_size = action_info.get_max_block_number() if \
+            action_info.get_max_block_number() > max_size else max_size
+        self.action_file_list.append(action_info)
+        if OPTIONS_MANAGER.stream_update:
+            self.no_copy_list.append(tgt_blocks)
+        return max_size
+
+    def get_src_block_index(self):
+        """
+        Index the blocks of the source files by crc32, the index is built
+        the first time a target file has no name match. The block data is
+        read through the image chunks, so sparse images are indexed too.
+        :return: dict of crc32 -> lowest source block with that crc32
+        """
+        if self.src_block_index is not None:
+            return self.src_block_index
+        block_size = self.src_img_obj.block_size
+        src_block_index = {}
+        for file_name, src_blocks in self.src_img_obj.file_map.items():
+            if file_name == FILE_MAP_ZERO_KEY:
+                continue
+            for start_value, end_value in src_blocks:
+                block = start_value
+                for data in self.src_img_obj.get_ranges(
+                        ((start_value, end_value),)):
+                    for pos in range(0, len(data), block_size):
+                        src_block_index.setdefault(
+                            zlib.crc32(data[pos:pos + block_size]), block)
+                        block += 1
+        self.src_block_index = src_block_index
+        return src_block_index
+
+    def get_content_file_name(self, src_blocks):
+        """
+        Get the source file holding most of the blocks matched by content.
+        :param src_blocks: matched source blocks
+        :return: source file name
+        """
+        if self.src_file_index is None:
+            self.src_file_index = BlocksOverlapIndex(
+                (file_name, blocks) for file_name, blocks in
+                self.src_img_obj.file_map.items()
+                if file_name != FILE_MAP_ZERO_KEY)
+        overlap_sizes = self.src_file_index.get_overlap_sizes(src_blocks)
+        return max(overlap_sizes, key=overlap_sizes.get)
+
+    def find_content_blocks(self, tgt_blocks):
+        """
+        Find the source blocks holding the data of the target blocks.
+        A crc32 hit is confirmed by comparing the block data, and the block
+        after the previous match is tried first so runs stay contiguous.
+        :param tgt_blocks: blocks of the target file
+        :return: matched source blocks in target order, repeated where
+                 target blocks hold the same data, None if too few blocks
+                 match
+        """
+        if tgt_blocks.size() == 0 or \
+                self.tgt_img_obj.block_size != self.src_img_obj.block_size:
+            return None
+        src_block_index = self.get_src_block_index()
+        get_src_block_data = self.src_img_obj.get_block_data
+        block_size = self.src_img_obj.block_size
+        matched_blocks = []
+        src_block = -1
+        for tgt_data in self.tgt_img_obj.get_ranges(tgt_blocks):
+            for pos in range(0, len(tgt_data), block_size):
+                data = tgt_data[pos:pos + block_size]
+                if src_block < 0 or \
+                        get_src_block_data(src_block + 1) != data:
+                    src_block = src_block_index.get(zlib.crc32(data), -1)
+                    if src_block < 0 or \
+                            get_src_block_data(src_block) != data:
+                        src_block = -1
+                        continue
+                else:
+                    src_block += 1
+                matched_blocks.append(src_block)
+        if len(matched_blocks) < tgt_blocks.size() * CONTENT_MATCH_RATIO:
+            return None
+        src_data = []
+        for src_block in matched_blocks:
+            if src_data and src_data[-1] == src_block:
+                src_data[-1] = src_block + 1
+            else:
+                src_data.extend((src_block, src_block + 1))
+        return BlocksManager(range_data=src_data)
+
+    def get_similarity_index(self):
+        """
+        Sketch the source files no target file is matched to by name, the
+        index is built the first time it is needed.
+        """
+        if self.src_similarity_index is not None:
+            return self.src_similarity_index
+        src_base_names, src_version_patterns = self.arrange_source_file()
+        name_matched = set()
+        for tgt_file_name in self.tgt_img_obj.file_map:
+            if tgt_file_name in self.src_img_obj.file_map:
+                name_matched.add(tgt_file_name)
+            else:
+                name_matched.add(self.get_file_name(
+                    src_base_names, src_version_patterns, tgt_file_name))
+        src_similarity_index = FileSimilarityIndex()
+        for file_name, src_blocks in self.src_img_obj.file_map.items():
+            if file_name in name_matched or \
+                    file_name in (FILE_MAP_ZERO_KEY, FILE_MAP_COPY_KEY) or \
+                    file_name.startswith(FILE_MAP_NONZERO_KEY):
+                continue
+            src_similarity_index.add(
+                file_name, b''.join(self.src_img_obj.get_ranges(src_blocks)))
+        self.src_similarity_index = src_similarity_index
+        return src_similarity_index
+
+    def get_similar_file_name(self, tgt_blocks):
+        """
+        Get the unmatched source file most similar to the target blocks.
+        :param tgt_blocks: blocks of the target file
+        :return: source file name, None if none is similar enough
+        """
+        src_file_name, score = self.get_similarity_index().find(
+            b''.join(self.tgt_img_obj.get_ranges(tgt_blocks)))
+        if src_file_name:
+            UPDATE_LOGGER.print_log(
+                "Similar source file %s, score %.2f" % (src_file_name, score))
+        return src_file_name
+
+    def split_large_actions(self, piece_blocks):
+        """
+        Split the DIFFERENT actions of at least two pieces into pieces
+        that pair the src and tgt blocks in order, so that each piece is
+        diffed on its own. The last piece also holds the short remainder
+        and the rest of the src blocks, so it has less than
+        2 * piece_blocks tgt blocks. Pieces left without src blocks
+        become NEW.
+        :param piece_blocks: number of blocks in a piece, 0 to not split
+        """
+        if piece_blocks <= 0:
+            return
+        action_file_list = []
+        for each_action in self.action_file_list:
+            tgt_blocks = each_action.tgt_block_set
+            src_blocks = each_action.src_block_set
+            if each_action.type_str != ActionType.DIFFERENT or \
+                    tgt_blocks.size() < piece_blocks * 2:
+                action_file_list.append(each_action)
+                continue
+            pieces = tgt_blocks.size() // piece_blocks
+            UPDATE_LOGGER.print_log(
+                "Split %s into %d pieces!" % (each_action.tgt_name, pieces))
+            for piece in range(pieces):
+                tgt_piece, src_piece = tgt_blocks, src_blocks
+                if piece < pieces - 1:
+                    tgt_piece, tgt_blocks = \
+                        tgt_blocks.split_first_block_obj(piece_blocks)
+                    if src_blocks.size() > piece_blocks:
+                        src_piece, src_blocks = \
+                            src_blocks.split_first_block_obj(piece_blocks)
+                    else:
+                        src_blocks = BlocksManager()
+                tgt_name = "%s-%d" % (each_action.tgt_name, piece)
+                if src_piece.size() == 0:
+                    action_file_list.append(ActionInfo(
+                        ActionType.NEW, tgt_name, None, tgt_piece, None))
+                    continue
+                action_file_list.append(ActionInfo(
+                    ActionType.DIFFERENT, tgt_name,
+                    "%s-%d" % (each_action.src_name, piece),
+                    tgt_piece, src_piece))
+        self.action_file_list = action_file_list
+
     def get_file_name(self, src_base_names, src_version_patterns,
                       tgt_file_name):
         tgt_base_name, tgt_version_patterns = \
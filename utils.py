@@ -146,6 +146,11 @@ class BaseOptionsManager:
         self.stream_update = False
         self.chunk_limit = 11       # chunk size 11 * 4096 = 44KB
         self.ab_partition_update = False
+        self.image_cache_dir = None
+        self.image_cache_size = 4096    # MiB
+        self.similarity_match = False
+        self.split_piece_blocks = 0     # blocks, 0 disables splitting
+        self.stash_budget = None        # MiB, None for DATA_SIZE
         
         self.make_dir_path = None
 